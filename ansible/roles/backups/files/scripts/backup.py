@@ -1,51 +1,344 @@
 #!/usr/bin/env python3
+import fcntl
+import glob
+import json
 import logging
 import os
-import platform
 import re
+import shlex
+import shutil
 import subprocess
 import sys
+import threading
+import time
 from argparse import ArgumentParser, Namespace
-from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, fields
 from datetime import datetime
-from typing import Any, ClassVar, List, Protocol, Type
+from typing import IO, Any, ClassVar, List, Protocol, Type
 
-import requests
+from checksum import CHECKSUM_SUFFIX, ChecksumFile
+from metrics import Metrics
+from notify import Notifier
+from runjournal import STATE_DIR, RunJournal, RunLockedError
+from sizeindex import SizeIndex, SizeSample
+from throttle import Throttle, add_throttle_arguments, apply_throttle_options
 
 _truthy_strs = ["true", "1", "y", "yes"]
 DEBUG = os.getenv("DEBUG", "").lower() in _truthy_strs
 DRY_RUN = os.getenv("DRY_RUN", "").lower() in _truthy_strs
-WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Remote datasets are managed over a shared (ControlMaster) ssh connection per host
+SSH_COMMAND = os.getenv("SSH_COMMAND", "ssh")
+# Also sample dataset sizes into the size index after each backup run
+COLLECT_SIZES = os.getenv("COLLECT_SIZES", "").lower() in _truthy_strs
+SSH_OPTIONS = (
+    "-o BatchMode=yes -o ControlMaster=auto -o ControlPersist=60 "
+    "-o ControlPath=~/.ssh/cm-backup-%C"
+)
+# Snapshot names are "<prefix>_<%y%m%d>_<%H%M%S>", see ZfsDataSet.create_snapshot
+SNAPSHOT_NAME_RE = re.compile(r"^(?P<prefix>.+)_(?P<timestamp>\d{6}_\d{6})$")
+SNAPSHOT_TIME_FMT = "%y%m%d_%H%M%S"
+# LVM archives are named backup_<lv>_<yy_mm_dd>.gz
+LVM_ARCHIVE_RE = r"^backup_{lv}_\d{{2}}_\d{{2}}_\d{{2}}\.gz$"
+# Retention buckets, snapshots with the same formatted creation time share a bucket
+RETENTION_BUCKETS = {
+    "hourly": "%Y%m%d%H",
+    "daily": "%Y%m%d",
+    "weekly": "%G%V",
+    "monthly": "%Y%m",
+    "yearly": "%Y",
+}
+# Stream relay settings for send | recv pipelines
+RELAY_CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 30
+# Recent transfers per target, used to estimate durations for DRY_RUN plans
+THROUGHPUT_HISTORY_FILE = os.path.join(STATE_DIR, "throughput.json")
+THROUGHPUT_HISTORY_LENGTH = 20
+# Dataset/snapshot size time series, for growth and days-to-full queries
+SIZE_INDEX_DIR = os.path.join(STATE_DIR, "sizes")
+METRICS = Metrics("backup")
+NOTIFIER = Notifier("backup")
+# Shared by all streams of the run, so the cap applies to the total of concurrent backups
+THROTTLE = Throttle()
 
 
 def main():
-    snapshotter, options = _get_snapshotter_from_args([ZfsSnapshotter])
+    snapshotters, options = _get_snapshotter_from_args([ZfsSnapshotter, LvmSnapshotter])
     logging.basicConfig(
         level=logging.DEBUG if DEBUG else logging.INFO,
-        format="[%(asctime)s] [%(levelname)8s] [%(funcName)12.12s()] %(message)s",
+        format=(
+            "[%(asctime)s] [%(levelname)8s] [%(threadName)10.10s] [%(funcName)12.12s()] %(message)s"
+        ),
         datefmt="%Y-%m-%d %H:%M:%S",
         filename=options.log_file,
     )
+    apply_throttle_options(options, THROTTLE)
+    if options.action != "backup":
+        if not all(isinstance(snapshotter, ZfsSnapshotter) for snapshotter in snapshotters):
+            print(f"ERROR: {options.action} is only supported for zfs")
+            return 1
+        if options.action == "collect-sizes":
+            samples = collect_sizes(snapshotters)
+            if DRY_RUN:
+                logging.info(f"Dry Run - would have added {len(samples)} size samples")
+            else:
+                SizeIndex(SIZE_INDEX_DIR).append(samples)
+                logging.info(f"Added {len(samples)} size samples to {SIZE_INDEX_DIR}")
+            return 0
+        print(json.dumps(size_report(snapshotters, options.growth_days), indent=2))
+        return 0
+    if DRY_RUN:
+        plan = json.dumps(plan_backups(snapshotters, options.workers), indent=2)
+        print(plan)
+        if options.summary_file:
+            with open(options.summary_file, "w") as f:
+                f.write(plan + "\n")
+        return 0
     # Check root perms
-    if not DRY_RUN and os.geteuid() != 0:
+    if os.geteuid() != 0:
         print("ERROR: Root permissions needed for Snapshots")
         return 1
+    results = run_backups(snapshotters, options.workers)
+    _record_throughput(results)
+    if COLLECT_SIZES and all(isinstance(s, ZfsSnapshotter) for s in snapshotters):
+        # A growth history without a separate collect-sizes cron job
+        try:
+            SizeIndex(SIZE_INDEX_DIR).append(collect_sizes(snapshotters))
+        except (BackupError, OSError) as e:
+            logging.warning(f"Unable to update the size index: {e}")
+    METRICS.flush()
+    for result in results:
+        logging.info(f"Backup result for {result.target}: {result.status}")
+    summary = json.dumps([result.summary() for result in results])
+    logging.info(f"Run summary: {summary}")
+    if options.summary_file:
+        with open(options.summary_file, "w") as f:
+            f.write(summary + "\n")
+    failures = [result for result in results if not result.ok]
+    for res in failures:
+        NOTIFIER.error(f"{res.target}: {res.error}")
+    if not failures:
+        NOTIFIER.success(", ".join(f"{res.target}: {res.status}" for res in results))
+    # Also sends anything left in the spool by earlier runs
+    NOTIFIER.flush()
+    return max((res.return_code for res in failures), default=0)
+
+
+def run_backups(snapshotters: list["Snapshotter"], workers: int) -> list["BackupResult"]:
+    """Run the backup for each snapshotter, concurrently if more than one worker is allowed
+
+    Results are returned in the same order as the snapshotters were provided. Backups that
+    share a dataset (see Snapshotter.locks) run one after the other in the same worker, so
+    they do not skip each other as locked
+    """
+    if workers <= 1 or len(snapshotters) == 1:
+        return [_run_backup(snapshotter) for snapshotter in snapshotters]
+    groups = _lock_groups(snapshotters)
+    logging.info(f"Running {len(snapshotters)} backups with {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backup") as pool:
+        group_results = pool.map(lambda group: [_run_backup(s) for _, s in group], groups)
+        results = {i: r for group, rs in zip(groups, group_results) for (i, _), r in zip(group, rs)}
+    return [results[i] for i in range(len(snapshotters))]
+
+
+def _lock_groups(snapshotters: list["Snapshotter"]) -> list[list[tuple[int, "Snapshotter"]]]:
+    """Group (index, snapshotter) by shared locks, directly or through other snapshotters"""
+    groups: list[tuple[set[str], list[tuple[int, "Snapshotter"]]]] = []
+    for i, snapshotter in enumerate(snapshotters):
+        locks, members = set(snapshotter.locks), [(i, snapshotter)]
+        for group in [g for g in groups if g[0] & locks]:
+            groups.remove(group)
+            locks |= group[0]
+            members = group[1] + members
+        groups.append((locks, sorted(members, key=lambda member: member[0])))
+    return [members for _, members in groups]
+
+
+def plan_backups(snapshotters: list["Snapshotter"], workers: int) -> list[dict[str, Any]]:
+    """Plan the backup for each snapshotter using read-only queries, nothing is changed"""
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="plan") as pool:
+        return list(pool.map(_plan_backup, snapshotters))
+
+
+def collect_sizes(snapshotters: list["ZfsSnapshotter"]) -> list[SizeSample]:
+    """Sample the sizes of the snapshotter datasets (and children) and their snapshots
+
+    Uses a single zfs list of the configured datasets per pool, pools are listed concurrently
+    """
+    datasets: dict[tuple[str | None, str], set[str]] = {}
+    for snapshotter in snapshotters:
+        for dataset in (snapshotter.source_dataset, snapshotter.dest_dataset):
+            if dataset is not None:
+                pool = dataset.name.split("/", 1)[0]
+                datasets.setdefault((dataset.remote_host, pool), set()).add(dataset.name)
+    prefixes = {snapshotter.snap_prefix for snapshotter in snapshotters}
+    sample_time = int(time.time())
+    with ThreadPoolExecutor(max_workers=len(datasets), thread_name_prefix="sizes") as pool:
+        results = pool.map(
+            lambda item: _list_pool_sizes(*item[0], item[1], prefixes, sample_time),
+            datasets.items(),
+        )
+        return [sample for samples in results for sample in samples]
+
+
+def size_report(snapshotters: list["ZfsSnapshotter"], growth_days: int) -> list[dict[str, Any]]:
+    """Current size, growth rate and days until full of each dataset, from the size index"""
+    index = SizeIndex(SIZE_INDEX_DIR).load()
+    since = int(time.time()) - growth_days * 24 * 3600
+    report = []
+    for snapshotter in snapshotters:
+        for dataset in (snapshotter.source_dataset, snapshotter.dest_dataset):
+            if dataset is None:
+                continue
+            series = index.dataset_series(str(dataset))
+            snapshots = index.latest_snapshots(str(dataset))
+            growth = index.growth_rate(str(dataset), since)
+            days_to_full = index.days_to_full(str(dataset), since)
+            largest = sorted(snapshots, key=lambda s: s.used, reverse=True)[:5]
+            report.append(
+                {
+                    "dataset": str(dataset),
+                    "samples": len(series),
+                    "used_bytes": series[-1][1] if series else None,
+                    "available_bytes": series[-1][2] if series and series[-1][2] >= 0 else None,
+                    "growth_bytes_per_day": round(growth) if growth is not None else None,
+                    "days_to_full": round(days_to_full, 1) if days_to_full else None,
+                    "snapshots": len(snapshots),
+                    "snapshots_used_bytes": sum(s.used for s in snapshots),
+                    "largest_snapshots": {s.snapshot: s.used for s in largest},
+                }
+            )
+    return report
+
+
+def _list_pool_sizes(
+    remote_host: str | None, pool: str, datasets: set[str], prefixes: set[str], sample_time: int
+) -> list[SizeSample]:
+    """Size samples of datasets (and their children) in a pool and their prefixed snapshots"""
+    # Children are listed with their parent, listing them again would duplicate samples
+    roots = [d for d in datasets if not any(d.startswith(f"{p}/") for p in datasets)]
+    res = _run_cmd(
+        ZfsDataSet(pool, remote_host).command(
+            "list -H -p -r -t filesystem,volume,snapshot "
+            f"-o name,used,referenced,written,creation,available {' '.join(sorted(roots))}"
+        ),
+        read_only=True,
+    )
+    samples = []
+    for line in res.stdout.decode().splitlines():
+        name, *values = line.split("\t")
+        dataset, _, snapshot = name.partition("@")
+        match = SNAPSHOT_NAME_RE.match(snapshot)
+        if snapshot and not (match and match.group("prefix") in prefixes):
+            continue
+        used, referenced, written, creation, available = (
+            int(v) if v.isdigit() else -1 for v in values
+        )
+        samples.append(
+            SizeSample(
+                time=sample_time,
+                dataset=str(ZfsDataSet(dataset, remote_host)),
+                snapshot=snapshot or None,
+                creation=creation,
+                used=used,
+                referenced=referenced,
+                written=written,
+                available=available,
+            )
+        )
+    return samples
+
+
+def _plan_backup(snapshotter: "Snapshotter") -> dict[str, Any]:
     try:
-        snap_name = snapshotter.create_source_snapshot()
-        snapshotter.backup_snapshot(snap_name)
-        snapshotter.prune()
+        return snapshotter.plan()
     except BackupError as e:
-        logging.error(str(e))
-        send_discord_notification(e)
-        return e.return_code
+        logging.error(f"{snapshotter.target}: {e}")
+        return {"target": snapshotter.target, "error": str(e)}
+
+
+def _run_backup(snapshotter: "Snapshotter") -> "BackupResult":
+    """Snapshot, send and prune a single backup target, capturing any failure in the result
+
+    The target is locked for the run and its steps journaled, an interrupted previous run is
+    resumed or rolled back by the snapshotter before anything else is done
+    """
+    result = BackupResult(snapshotter.target)
+    tags = {"type": snapshotter.name, "target": snapshotter.target}
+    counts: dict[str, int] = {}
+    start = time.monotonic()
+    try:
+        with RunJournal(snapshotter.target, locks=snapshotter.locks) as journal:
+            snap_name = None
+            if journal.interrupted:
+                with METRICS.phase("recover", **tags):
+                    snap_name = snapshotter.recover(journal)
+            if snap_name is None:
+                journal.complete()
+                with METRICS.phase("snapshot", **tags):
+                    snap_name = snapshotter.create_source_snapshot(journal)
+            if "backed_up" not in journal:
+                with METRICS.phase("transfer", **tags) as phase:
+                    result.transfer = snapshotter.backup_snapshot(snap_name, journal)
+                    if result.transfer:
+                        phase["bytes"] = result.transfer.bytes
+                journal.record("backed_up")
+            with METRICS.phase("prune", **tags) as phase:
+                counts = snapshotter.prune()
+                phase["pruned"] = counts.get("pruned")
+            journal.complete()
+    except RunLockedError as e:
+        logging.warning(f"{snapshotter.target}: {e} - skipping")
+        result.skipped = str(e)
+    except BackupError as e:
+        logging.error(f"{snapshotter.target}: {e}")
+        result.error, result.return_code = e, e.return_code
     except Exception as e:
-        send_discord_notification(e)
-        raise
+        logging.exception(f"{snapshotter.target}: Unexpected error during backup")
+        result.error, result.return_code = e, 1
+    METRICS.add(
+        "backup_run",
+        {
+            "ok": result.ok,
+            "skipped": result.skipped is not None,
+            "return_code": result.return_code,
+            "duration_s": time.monotonic() - start,
+            "bytes": result.transfer.bytes if result.transfer else None,
+            "bytes_per_sec": result.transfer.rate if result.transfer else None,
+            **counts,
+        },
+        **tags,
+    )
+    return result
 
 
 def _get_snapshotter_from_args(supported_snapshotters: List[Type["Snapshotter"]]):
     p = ArgumentParser()
+    p.add_argument(
+        "action",
+        nargs="?",
+        default="backup",
+        choices=["backup", "collect-sizes", "size-report"],
+        help=(
+            "Run the backup, add a sample of dataset and snapshot sizes to the size index, or "
+            "report growth and days until full from it (Default: %(default)s)"
+        ),
+    )
     p.add_argument("--log-file", type=str, help="Log File location")
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Max number of backups to run concurrently (Default: %(default)s)",
+    )
+    p.add_argument("--summary-file", type=str, help="Write the JSON run summary to this file")
+    p.add_argument(
+        "--growth-days",
+        type=int,
+        default=30,
+        help="Days of size samples to base size-report growth rates on (Default: %(default)s)",
+    )
     p.add_argument(
         "--type",
         dest="snapshotter_type",
@@ -53,14 +346,21 @@ def _get_snapshotter_from_args(supported_snapshotters: List[Type["Snapshotter"]]
         choices=[st.name for st in supported_snapshotters],
         help="Snapshotter Type",
     )
+    add_throttle_arguments(p)
     for snapshotter_type in supported_snapshotters:
         grp = p.add_argument_group(snapshotter_type.name)
         for arg, kwargs in snapshotter_type.args.items():
             grp.add_argument(arg, **kwargs)
     options = p.parse_args()
     snapshotter_type = options.__dict__.pop("snapshotter_type")
-    snapshotter = next(st for st in supported_snapshotters if st.name == snapshotter_type)(options)
-    return snapshotter, options
+    snapshotter_cls = next(st for st in supported_snapshotters if st.name == snapshotter_type)
+    try:
+        snapshotters = snapshotter_cls.from_options(options)
+    except BackupError as e:
+        p.error(str(e))
+    if not snapshotters:
+        p.error(f"No backup targets provided for type: {snapshotter_type}")
+    return snapshotters, options
 
 
 class BackupError(RuntimeError):
@@ -73,6 +373,62 @@ class BackupError(RuntimeError):
         self.return_code = return_code
 
 
+@dataclass
+class BackupResult:
+    """Outcome of a single backup target run"""
+
+    target: str
+    error: Exception | None = None
+    return_code: int = 0
+    transfer: "TransferStats | None" = None
+    skipped: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def status(self) -> str:
+        if self.skipped:
+            return f"SKIPPED ({self.skipped})"
+        return "OK" if self.ok else f"FAILED ({self.error})"
+
+    def summary(self) -> dict[str, Any]:
+        """Machine readable summary of the result"""
+        return {
+            "target": self.target,
+            "ok": self.ok,
+            "return_code": self.return_code,
+            "error": str(self.error) if self.error else None,
+            "skipped": self.skipped,
+            "transfer": self.transfer.summary() if self.transfer else None,
+        }
+
+
+@dataclass
+class TransferStats:
+    """Throughput of one or more streamed transfers"""
+
+    bytes: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Bytes per second"""
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __add__(self, other: "TransferStats") -> "TransferStats":
+        return TransferStats(self.bytes + other.bytes, self.elapsed + other.elapsed)
+
+    def __str__(self) -> str:
+        return (
+            f"{_format_bytes(self.bytes)} in {self.elapsed:.1f}s " f"({_format_bytes(self.rate)}/s)"
+        )
+
+    def summary(self) -> dict[str, Any]:
+        return {**asdict(self), "bytes_per_sec": round(self.rate)}
+
+
 class SnapShotVolume(Protocol):
     name: ClassVar[str]
 
@@ -101,13 +457,38 @@ class Snapshotter(Protocol):
     def __init__(self, options: Namespace) -> None:
         ...
 
-    def create_source_snapshot(self) -> str:
+    @classmethod
+    def from_options(cls, options: Namespace) -> list["Snapshotter"]:
+        ...
+
+    @property
+    def target(self) -> str:
+        ...
+
+    @property
+    def locks(self) -> list[str]:
+        """Datasets/LVs the backup touches, no two runs can touch one at the same time"""
+        ...
+
+    def recover(self, journal: RunJournal) -> str | None:
+        """Resume or roll back the interrupted run in the journal
+
+        Returns the snapshot to continue the run with, or None to start a new one
+        """
         ...
 
-    def backup_snapshot(self, snapshot: str):
+    def plan(self) -> dict[str, Any]:
+        """What a run would do, and its estimated cost, from read-only queries"""
         ...
 
-    def prune(self):
+    def create_source_snapshot(self, journal: RunJournal) -> str:
+        ...
+
+    def backup_snapshot(self, snapshot: str, journal: RunJournal) -> TransferStats | None:
+        ...
+
+    def prune(self) -> dict[str, int]:
+        """Prune, returning counts of what was pruned and what is kept, e.g. for metrics"""
         ...
 
 
@@ -115,49 +496,271 @@ class Snapshotter(Protocol):
 class ZfsDataSet:
     name: str
     remote_host: str | None = None
+    # Snapshot inventory: prefix -> {snapshot name: createtxg}, listed once and kept updated.
+    # Snapshots not named by create_snapshot are kept under a None prefix
+    _snapshots: dict[str | None, dict[str, int]] | None = field(
+        default=None, init=False, repr=False, compare=False
+    )
+    # Bookmark name -> createtxg, listed along with the snapshots
+    _bookmarks: dict[str, int] = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    def __str__(self) -> str:
+        return f"{self.remote_host}:{self.name}" if self.remote_host else self.name
+
+    def command(self, zfs_args: str) -> str:
+        """Build a zfs command for this dataset, run over ssh if the dataset is remote"""
+        if not self.remote_host:
+            return f"zfs {zfs_args}"
+        return f"{SSH_COMMAND} {SSH_OPTIONS} {self.remote_host} zfs {zfs_args}"
 
     def exists(self):
-        return _run_cmd(f"zfs list -H {self.name}", check=False).returncode == 0
+        res = _run_cmd(self.command(f"list -H {self.name}"), check=False, read_only=True)
+        return res.returncode == 0
 
     def create(self):
-        logging.info(f"Creating ZFS Dataset: {self.name}")
-        _run_cmd(f"zfs create {self.name}")
+        logging.info(f"Creating ZFS Dataset: {self}")
+        _run_cmd(self.command(f"create {self.name}"))
+        self._snapshots, self._bookmarks = {}, {}
+
+    def get_property(self, prop: str) -> str | None:
+        """Get a single ZFS property value, None if unset"""
+        res = _run_cmd(self.command(f"get -H -p -o value {prop} {self.name}"), read_only=True)
+        value = res.stdout.decode().strip() if res.stdout else None
+        return value if value and value != "-" else None
+
+    def abort_partial_receive(self):
+        """Discard any partially received (resumable) state on this dataset"""
+        logging.info(f"Aborting partial receive on {self}")
+        _run_cmd(self.command(f"recv -A {self.name}"))
+        self.refresh_snapshots()
+
+    def refresh_snapshots(self):
+        """Drop the snapshot inventory so it is listed again on next use"""
+        self._snapshots, self._bookmarks = None, {}
+
+    @staticmethod
+    def snapshot_name(snapshot_prefix: str) -> str:
+        """Name for a snapshot taken now"""
+        return f"{snapshot_prefix}_{datetime.now().strftime(SNAPSHOT_TIME_FMT)}"
 
     def create_snapshot(self, snapshot_prefix: str) -> str:
-        date_str = datetime.now().strftime("%y%m%d_%H%M%S")
-        snapshot_name = f"{snapshot_prefix}_{date_str}"
+        snapshot_name = self.snapshot_name(snapshot_prefix)
         logging.info("Taking zfs snapshot: " + snapshot_name)
-        _run_cmd(f"zfs snap -r {self.name}@{snapshot_name}")
+        _run_cmd(self.command(f"snap -r {self.name}@{snapshot_name}"))
+        self._add_snapshot(snapshot_name)
         return snapshot_name
 
     def get_snapshots(self, snapshot_prefix: str) -> list[str]:
         """Get a list of snapshot names matching prefix, sorted by time ascending"""
-        logging.debug(f"Getting snapshots for {self.name}")
-        snap_pattern = rf"{self.name}@({snapshot_prefix}_\d+_\d+)"
-        res = _run_cmd(f"zfs list -H -t snap {self.name}")
-        snap_names = []
-        for line in res.stdout.splitlines():
-            stripped_line = line.decode().split()[0]
-            logging.debug(f"Parsing snapshot output: {stripped_line}")
-            match = re.match(snap_pattern, stripped_line)
-            if not match:
-                logging.debug(f"No match for snapshot: {stripped_line} with pattern {snap_pattern}")
-                continue
-            snap_names.append(match.group(1))
-        snap_names.sort()
-        logging.debug(f"Found snapshots: {snap_names}")
+        snap_names = sorted(self._get_inventory().get(snapshot_prefix, {}))
+        logging.debug(f"Found snapshots on {self}: {snap_names}")
         return snap_names
 
     def delete_snapshot(self, snapshot: str):
-        logging.info(f"Deleting Snapshot: {snapshot}")
-        _run_cmd(f"zfs destroy -R {self.name}@{snapshot}")
+        self.delete_snapshots([snapshot])
+
+    def delete_snapshots(self, snapshots: list[str]):
+        """Destroy all the given snapshots in a single zfs destroy (and txg sync)
+
+        Snapshots that are adjacent in creation order are collapsed into 'first%last' ranges,
+        only ever spanning snapshots that are all being deleted
+        """
+        if not snapshots:
+            return
+        logging.info(f"Deleting Snapshots on {self}: {snapshots}")
+        _run_cmd(self.command(f"destroy -R {self.name}@{self._destroy_spec(snapshots)}"))
+        for snapshot in snapshots:
+            self._remove_snapshot(snapshot)
+
+    def get_bookmarks(self, snapshot_prefix: str) -> list[str]:
+        """Get a list of bookmark names matching prefix, sorted by time ascending"""
+        self._get_inventory()
+        return sorted(
+            bookmark
+            for bookmark in self._bookmarks
+            if (match := SNAPSHOT_NAME_RE.match(bookmark))
+            and match.group("prefix") == snapshot_prefix
+        )
+
+    def create_bookmark(self, snapshot: str):
+        """Bookmark a snapshot (under the same name) so it can be an incremental source later"""
+        logging.info(f"Bookmarking snapshot {self}@{snapshot}")
+        _run_cmd(self.command(f"bookmark {self.name}@{snapshot} {self.name}#{snapshot}"))
+        snaps = self._get_inventory()
+        createtxg = next((s[snapshot] for s in snaps.values() if snapshot in s), self._last_txg())
+        self._bookmarks[snapshot] = createtxg
+
+    def delete_bookmarks(self, bookmarks: list[str]):
+        """Destroy bookmarks, zfs destroy only takes a single bookmark at a time"""
+        for bookmark in bookmarks:
+            logging.info(f"Deleting Bookmark: {self}#{bookmark}")
+            _run_cmd(self.command(f"destroy {self.name}#{bookmark}"))
+            self._bookmarks.pop(bookmark, None)
+
+    def record_received(
+        self,
+        snapshot: str,
+        source: "ZfsDataSet",
+        incremental: bool,
+        replication: bool = True,
+        forced: bool = True,
+    ):
+        """Update the inventory after receiving a stream of snapshot from source
+
+        A full replication stream carries every source snapshot up to the one sent, while a
+        forced (-F) incremental receive of a replication stream destroys any snapshots no
+        longer on the sending side. A plain (not replication) stream, or an incremental
+        receive that is not forced, only adds the snapshot sent
+        """
+        inventory = self._get_inventory()
+        source_inventory = source._get_inventory()
+        if not replication:
+            self._add_snapshot(snapshot)
+            return
+        if incremental and not forced:
+            self._add_snapshot(snapshot)
+            return
+        if incremental:
+            for prefix, snaps in inventory.items():
+                for snap_name in [s for s in snaps if s not in source_inventory.get(prefix, {})]:
+                    self._remove_snapshot(snap_name)
+            self._add_snapshot(snapshot)
+            return
+        source_snaps = {s: txg for snaps in source_inventory.values() for s, txg in snaps.items()}
+        sent_txg = source_snaps.get(snapshot, source._last_txg())
+        for snap_name in sorted(source_snaps, key=source_snaps.__getitem__):
+            if source_snaps[snap_name] <= sent_txg:
+                self._add_snapshot(snap_name)
+
+    def _destroy_spec(self, snapshots: list[str]) -> str:
+        """Build the comma separated snapshot list/range spec for zfs destroy"""
+        to_delete = set(snapshots)
+        all_snaps = {s: txg for snaps in self._get_inventory().values() for s, txg in snaps.items()}
+        runs: list[list[str]] = [[snap] for snap in snapshots if snap not in all_snaps]
+        in_run = False
+        for snap in sorted(all_snaps, key=all_snaps.__getitem__):
+            if snap in to_delete and in_run:
+                runs[-1].append(snap)
+            elif snap in to_delete:
+                runs.append([snap])
+            in_run = snap in to_delete
+        return ",".join(run[0] if len(run) == 1 else f"{run[0]}%{run[-1]}" for run in runs)
+
+    def _get_inventory(self) -> dict[str | None, dict[str, int]]:
+        """Get the snapshot inventory, listing the dataset snapshots on first use only"""
+        if self._snapshots is None:
+            logging.debug(f"Getting snapshots for {self}")
+            self._snapshots, self._bookmarks = {}, {}
+            res = _run_cmd(
+                self.command(f"list -H -p -o name,createtxg -t snapshot,bookmark -d 1 {self.name}"),
+                read_only=True,
+            )
+            for line in res.stdout.splitlines():
+                full_name, createtxg = line.decode().split("\t")
+                if "#" in full_name:
+                    self._bookmarks[full_name.split("#", 1)[1]] = int(createtxg)
+                else:
+                    self._add_snapshot(full_name.split("@", 1)[1], int(createtxg))
+        return self._snapshots
+
+    def _add_snapshot(self, snapshot: str, createtxg: int | None = None):
+        if self._snapshots is None:
+            # Inventory not listed yet, it will pick this snapshot up when it is
+            return
+        match = SNAPSHOT_NAME_RE.match(snapshot)
+        if createtxg is None:
+            # Actual txg is not reported on creation, but it is always later than any existing
+            createtxg = self._last_txg() + 1
+        prefix = match.group("prefix") if match else None
+        self._snapshots.setdefault(prefix, {})[snapshot] = createtxg
+
+    def _last_txg(self) -> int:
+        txgs = [txg for snaps in (self._snapshots or {}).values() for txg in snaps.values()]
+        return max(txgs, default=0)
+
+    def _remove_snapshot(self, snapshot: str):
+        if self._snapshots is None:
+            return
+        match = SNAPSHOT_NAME_RE.match(snapshot)
+        prefix = match.group("prefix") if match else None
+        self._snapshots.get(prefix, {}).pop(snapshot, None)
+
+
+@dataclass
+class RetentionPolicy:
+    """Snapshots to keep: the latest N, plus the newest snapshot in each of the latest N
+    hourly/daily/weekly/monthly/yearly buckets
+    """
+
+    last: int = 0
+    hourly: int = 0
+    daily: int = 0
+    weekly: int = 0
+    monthly: int = 0
+    yearly: int = 0
+
+    @staticmethod
+    def from_spec(spec: str) -> "RetentionPolicy":
+        """Parse a policy like 'last=3,hourly=24,daily=7,weekly=4,monthly=12'"""
+        counts = {}
+        for rule in spec.split(","):
+            name, _, count = rule.strip().partition("=")
+            if name not in ("last", *RETENTION_BUCKETS) or not count.isdigit():
+                raise BackupError(f"Invalid retention rule '{rule}' in policy: {spec}")
+            counts[name] = int(count)
+        return RetentionPolicy(**counts)
+
+    def select_expired(self, snapshots: list[str]) -> list[str]:
+        """Get the snapshots (sorted by time ascending) not kept by this policy
+
+        Snapshots without a parsable timestamp in the name are never expired
+        """
+        newest_first = list(reversed(snapshots))
+        keep = set(newest_first[: self.last])
+        timestamps = {}
+        for snap in newest_first:
+            match = SNAPSHOT_NAME_RE.match(snap)
+            try:
+                timestamps[snap] = datetime.strptime(match.group("timestamp"), SNAPSHOT_TIME_FMT)
+            except (AttributeError, ValueError):
+                keep.add(snap)
+        for bucket, bucket_fmt in RETENTION_BUCKETS.items():
+            seen_buckets = set()
+            for snap, timestamp in timestamps.items():
+                if len(seen_buckets) >= getattr(self, bucket):
+                    break
+                bucket_key = timestamp.strftime(bucket_fmt)
+                if bucket_key not in seen_buckets:
+                    seen_buckets.add(bucket_key)
+                    keep.add(snap)
+        return [snap for snap in snapshots if snap not in keep]
+
+    def keeps_more_than(self, other: "RetentionPolicy") -> bool:
+        """Whether this policy can keep snapshots that other expires"""
+        return any(getattr(self, f.name) > getattr(other, f.name) for f in fields(self))
 
 
 class ZfsSnapshotter:
     name: ClassVar = "zfs"
     args: ClassVar = {
-        "--src-dataset": {"help": "Source ZFS Dataset for Snapshot", "required": True},
+        "--src-dataset": {"help": "Source ZFS Dataset for Snapshot"},
         "--dest-dataset": {"help": "Destination Backup Dataset"},
+        "--dest-host": {
+            "help": "Remote host (ssh destination) for destination datasets, default is local",
+        },
+        "--dataset-pair": {
+            "help": "Source and Destination dataset pair to replicate (can be repeated)",
+            "nargs": 2,
+            "metavar": ("SRC", "DEST"),
+            "action": "append",
+            "default": [],
+        },
+        "--datasets-file": {
+            "help": ("File of '<src> <dest> [dest-host]' dataset pairs to replicate, one per line"),
+        },
+        "--mbuffer-size": {
+            "help": "Buffer the stream to remote destinations with mbuffer of this size (e.g. 1G)",
+        },
         "--dest-directory": {"help": "Destination Backup Directory"},
         "--snap-prefix": {"help": "Snapshot Name Prefix", "default": "backup"},
         "--num-snaps": {
@@ -165,90 +768,720 @@ class ZfsSnapshotter:
             "type": int,
             "default": 3,
         },
+        "--source-num-snaps": {
+            "help": "Number of Snapshots to keep on the Source (Default: --num-snaps)",
+            "type": int,
+        },
+        "--retention": {
+            "help": (
+                "Retention policy instead of --num-snaps, e.g. 'last=3,hourly=24,daily=7,"
+                "weekly=4,monthly=12,yearly=2'"
+            ),
+        },
+        "--source-retention": {
+            "help": (
+                "Retention policy for the Source (Default: --source-num-snaps/--retention), "
+                "if the Destination keeps more it is received without -F, so must be readonly"
+            ),
+        },
+        "--bookmarks": {
+            "help": (
+                "Bookmark sent snapshots on the Source and use them as incremental sources, "
+                "so Source snapshots can be pruned aggressively"
+            ),
+            "action": "store_true",
+        },
+        "--send-compressed": {
+            "help": "Send blocks compressed as stored on disk (zfs send -c)",
+            "action": "store_true",
+        },
+        "--send-large-block": {
+            "help": "Allow blocks larger than 128KiB in the stream (zfs send -L)",
+            "action": "store_true",
+        },
+        "--send-embedded": {
+            "help": "Send embedded data blocks as-is (zfs send -e)",
+            "action": "store_true",
+        },
+        "--send-raw": {
+            "help": "Send encrypted/compressed data exactly as stored (zfs send -w)",
+            "action": "store_true",
+        },
+        "--resumable": {
+            "help": "Receive with resume tokens (-s) and resume interrupted transfers first",
+            "action": "store_true",
+        },
+    }
+
+    send_flag_options: ClassVar = {
+        "send_compressed": "-c",
+        "send_large_block": "-L",
+        "send_embedded": "-e",
+        "send_raw": "-w",
     }
 
     snap_prefix: str
     source_dataset: ZfsDataSet
     dest_dataset: ZfsDataSet | None = None
+    source_retention: RetentionPolicy
+    dest_retention: RetentionPolicy
 
     def __init__(self, options: Namespace) -> None:
         self.options = options
         # Convenience helpers from class options
         self.snap_prefix = options.snap_prefix
         self.source_dataset = ZfsDataSet(options.src_dataset)
-        self.dest_dataset = ZfsDataSet(options.dest_dataset) if options.dest_dataset else None
+        self.dest_dataset = (
+            ZfsDataSet(options.dest_dataset, remote_host=options.dest_host)
+            if options.dest_dataset
+            else None
+        )
+        if options.retention:
+            self.dest_retention = RetentionPolicy.from_spec(options.retention)
+        else:
+            self.dest_retention = RetentionPolicy(last=options.num_snaps)
+        if options.source_retention:
+            self.source_retention = RetentionPolicy.from_spec(options.source_retention)
+        elif options.source_num_snaps is not None:
+            self.source_retention = RetentionPolicy(last=options.source_num_snaps)
+        else:
+            self.source_retention = self.dest_retention
+
+    @classmethod
+    def from_options(cls, options: Namespace) -> list["ZfsSnapshotter"]:
+        """Build a snapshotter per source/destination pair provided in the options"""
+        if options.source_num_snaps == 0 and not options.bookmarks:
+            raise BackupError("Keeping no Source snapshots needs --bookmarks for incrementals")
+        pairs = [(src, dest, options.dest_host) for src, dest in options.dataset_pair]
+        if options.datasets_file:
+            pairs.extend(_read_dataset_pairs(options.datasets_file, options.dest_host))
+        if options.src_dataset:
+            pairs.insert(0, (options.src_dataset, options.dest_dataset, options.dest_host))
+        return [
+            cls(
+                Namespace(
+                    **{
+                        **vars(options),
+                        "src_dataset": src,
+                        "dest_dataset": dest,
+                        "dest_host": dest_host,
+                    }
+                )
+            )
+            for src, dest, dest_host in pairs
+        ]
+
+    @property
+    def target(self) -> str:
+        return f"{self.source_dataset} -> {self.dest_dataset}"
+
+    @property
+    def locks(self) -> list[str]:
+        return [f"zfs:{self.source_dataset}", f"zfs:{self.dest_dataset}"]
+
+    def plan(self) -> dict[str, Any]:
+        """Incremental base, estimated transfer and snapshots a run would prune"""
+        if not self.source_dataset.exists():
+            raise BackupError(f"Dataset does not exist: {self.source_dataset.name}")
+        if not self.dest_dataset:
+            raise BackupError("Error: Destination Dataset for backups not provided")
+        snapshot = self.source_dataset.snapshot_name(self.snap_prefix)
+        dest_exists = self.dest_dataset.exists()
+        dest_snaps = self.dest_dataset.get_snapshots(self.snap_prefix) if dest_exists else []
+        incremental_src = self._get_incremental_source(self.source_dataset, dest_snaps)
+        replication = self._use_replication(incremental_src)
+        estimated_bytes = self._estimate_new_snapshot_size(incremental_src, replication)
+        # A new destination is created under its parent, which has the space accounting
+        space_dataset = self.dest_dataset
+        if not dest_exists:
+            space_dataset = ZfsDataSet(
+                os.path.dirname(self.dest_dataset.name) or self.dest_dataset.name,
+                self.dest_dataset.remote_host,
+            )
+        available = space_dataset.get_property("available")
+        source_snaps = [*self.source_dataset.get_snapshots(self.snap_prefix), snapshot]
+        plan = {
+            "target": self.target,
+            "snapshot": snapshot,
+            "dest_exists": dest_exists,
+            "incremental_base": incremental_src,
+            "replication": replication,
+            "resume_pending": bool(
+                dest_exists
+                and self.options.resumable
+                and self.dest_dataset.get_property("receive_resume_token")
+            ),
+            "estimated_bytes": estimated_bytes,
+            **_estimate_duration(self.target, estimated_bytes),
+            "dest_available_bytes": int(available) if available else None,
+            "prune": {
+                "source": self.source_retention.select_expired(source_snaps),
+                "dest": self.dest_retention.select_expired([*dest_snaps, snapshot]),
+            },
+        }
+        if self.options.bookmarks:
+            bookmarks = [*self.source_dataset.get_bookmarks(self.snap_prefix), snapshot]
+            plan["prune"]["bookmarks"] = list(reversed(bookmarks))[self.options.num_snaps :]
+        # What pruning frees, as far as the size index knows the snapshots
+        index = SizeIndex(SIZE_INDEX_DIR).load()
+        plan["prune_used_bytes"] = {
+            "source": _indexed_snapshots_used(index, self.source_dataset, plan["prune"]["source"]),
+            "dest": _indexed_snapshots_used(index, self.dest_dataset, plan["prune"]["dest"]),
+        }
+        return plan
+
+    def recover(self, journal: RunJournal) -> str | None:
+        """Continue with the snapshot of the interrupted run if it still exists on the source
+
+        An interrupted send is picked up again from its resume token with --resumable
+        """
+        snapshot = journal.get("snapshot")
+        if snapshot is None:
+            return None
+        if "backed_up" in journal:
+            logging.info(f"Snapshot {snapshot} was already sent, resuming from prune")
+            return snapshot
+        if snapshot not in self.source_dataset.get_snapshots(self.snap_prefix):
+            logging.warning(f"Snapshot {snapshot} of the interrupted run is gone, starting over")
+            return None
+        logging.info(f"Resuming backup of interrupted run from snapshot {snapshot}")
+        return snapshot
 
-    def create_source_snapshot(self) -> str:
+    def create_source_snapshot(self, journal: RunJournal) -> str:
         """Create a Snapshot for Backup on the defined source dataset"""
         if not self.source_dataset.exists():
             raise BackupError(f"Dataset does not exist: {self.source_dataset.name}")
-        return self.source_dataset.create_snapshot(self.snap_prefix)
+        snapshot = self.source_dataset.create_snapshot(self.snap_prefix)
+        journal.record("snapshot", snapshot)
+        return snapshot
 
-    def backup_snapshot(self, snapshot: str):
+    def backup_snapshot(self, snapshot: str, journal: RunJournal) -> TransferStats:
         """Send Snapshot to the designated targets"""
         if not self.dest_dataset:
             raise BackupError("Error: Destination Dataset for backups not provided")
+        transfer = TransferStats()
         if not self.dest_dataset.exists():
             self.dest_dataset.create()
-        # Try to locate a source snap for incremental replication
+        elif self.options.resumable:
+            transfer += self._resume_interrupted_receive()
         dest_snaps = self.dest_dataset.get_snapshots(self.snap_prefix)
+        if snapshot in dest_snaps:
+            # An interrupted run got as far as receiving it (or the resume token finished it)
+            logging.info(f"Snapshot {snapshot} is already on {self.dest_dataset}, not sending")
+            self._bookmark_sent(snapshot)
+            return transfer
+        # Try to locate a source snap for incremental replication
         incremental_src = self._get_incremental_source(self.source_dataset, dest_snaps)
         source_ds = self.source_dataset.name
+        replication = self._use_replication(incremental_src)
         if incremental_src:
             logging.info(
-                f"Found incremental source snapshot {incremental_src} and matching replica on "
+                f"Found incremental source {incremental_src} and matching replica on "
                 "destination - using incremental snapshot"
             )
-            src_path = f"-i {source_ds}@{incremental_src} {source_ds}@{snapshot}"
+            src_path = f"-i {source_ds}{incremental_src} {source_ds}@{snapshot}"
         else:
             logging.info("No source snapshots for Incremental Replication - making full copy")
             src_path = f"{source_ds}@{snapshot}"
-        _run_cmd(
-            f"zfs send -R {src_path} | zfs recv -F {self.dest_dataset.name}",
-            shell=True,
+        if not replication:
+            logging.warning(
+                f"Sending from bookmark {incremental_src}, child datasets are not included"
+            )
+        send_flags = ["-R"] if replication else []
+        send_flags += [
+            flag for opt, flag in self.send_flag_options.items() if getattr(self.options, opt)
+        ]
+        send_args = " ".join([*send_flags, src_path])
+        expected_bytes = self._estimate_send_size(send_args)
+        recv_flags = self._receive_flags(incremental=incremental_src is not None)
+        transfer += _run_pipeline(
+            self.source_dataset.command(f"send {send_args}"),
+            *self._receive_commands(recv_flags),
+            expected_bytes=expected_bytes,
+        )
+        self.dest_dataset.record_received(
+            snapshot,
+            self.source_dataset,
+            incremental=incremental_src is not None,
+            replication=replication,
+            forced="-F" in recv_flags,
         )
+        self._bookmark_sent(snapshot)
+        logging.info(f"Replicated {self.target}: {transfer}")
+        return transfer
+
+    def _bookmark_sent(self, snapshot: str):
+        if self.options.bookmarks and snapshot not in self.source_dataset.get_bookmarks(
+            self.snap_prefix
+        ):
+            self.source_dataset.create_bookmark(snapshot)
+
+    def _use_replication(self, incremental_src: str | None) -> bool:
+        """Whether to send a replication (-R) stream, including child datasets
+
+        Replication streams can not be based on a bookmark, that only sends the dataset
+        """
+        return not incremental_src or not incremental_src.startswith("#")
+
+    def _receive_flags(self, incremental: bool) -> str:
+        """zfs recv flags, forced (-F) unless the destination keeps more than the source
+
+        A forced incremental receive of a replication stream destroys destination snapshots
+        no longer on the source, undoing a destination retention that keeps any snapshot the
+        source retention expires (e.g. --num-snaps above --source-num-snaps). Without -F they
+        are kept, but the receive fails if the destination was modified since its latest
+        snapshot, so it should be readonly. Full receives are always forced, into the
+        destination created for them
+        """
+        flags = []
+        if not incremental or not self.dest_retention.keeps_more_than(self.source_retention):
+            flags.append("-F")
+        if self.options.resumable:
+            flags.append("-s")
+        return " ".join(flags)
+
+    def _receive_commands(self, recv_flags: str) -> list[str]:
+        """Commands for the receiving end of the stream, buffered with mbuffer if remote"""
+        recv_command = self.dest_dataset.command(f"recv {recv_flags} {self.dest_dataset.name}")
+        if self.dest_dataset.remote_host and self.options.mbuffer_size:
+            return [f"mbuffer -q -s 128k -m {self.options.mbuffer_size}", recv_command]
+        return [recv_command]
+
+    def _estimate_send_size(self, send_args: str) -> int | None:
+        """Get the expected stream size from a zfs send dry run (-nvP)"""
+        res = _run_cmd(
+            self.source_dataset.command(f"send -nvP {send_args}"), check=False, read_only=True
+        )
+        if res.returncode != 0:
+            logging.warning(f"Unable to estimate send size: {res.stderr.decode().strip()}")
+            return None
+        # Parsable output ends with a "size <bytes>" total line, older zfs prints it to stderr
+        output = (res.stdout or b"") + (res.stderr or b"")
+        sizes = re.findall(r"^size\s+(\d+)$", output.decode(), re.MULTILINE)
+        if not sizes:
+            return None
+        expected_bytes = int(sizes[-1])
+        logging.info(f"Estimated send size for {self.target}: {_format_bytes(expected_bytes)}")
+        return expected_bytes
 
-    def prune(self):
-        """Prune Source snaps not needed (and Destination if using snapshot replication)"""
+    def _estimate_new_snapshot_size(
+        self, incremental_src: str | None, replication: bool
+    ) -> int | None:
+        """Estimate the stream size for a snapshot that has not been taken yet
+
+        zfs send -nvP needs the snapshot to exist, so this uses the space accounting it is
+        based on: data written since the incremental base, or all data for a full copy
+        """
+        compressed = self.options.send_compressed or self.options.send_raw
+        if incremental_src:
+            prop = f"written{incremental_src}"
+        elif replication:
+            # Full replication streams carry every snapshot and child dataset
+            prop = "used" if compressed else "logicalused"
+        else:
+            prop = "referenced" if compressed else "logicalreferenced"
+        recursive = "-r " if replication and incremental_src else ""
+        res = _run_cmd(
+            self.source_dataset.command(
+                f"get {recursive}-H -p -o value {prop} {self.source_dataset.name}"
+            ),
+            check=False,
+            read_only=True,
+        )
+        if res.returncode != 0:
+            logging.warning(f"Unable to estimate send size: {res.stderr.decode().strip()}")
+            return None
+        values = [v for v in res.stdout.decode().split() if v.isdigit()]
+        return sum(int(v) for v in values) if values else None
+
+    def _resume_interrupted_receive(self) -> TransferStats:
+        """Finish a previously interrupted transfer to the destination from its resume token
+
+        If the token can no longer be resumed from (e.g. the source snapshot is gone), the
+        partial state is discarded so the normal incremental/full path can run. A failure part
+        way through the resumed stream is raised, keeping the partial state (and its progress)
+        for the next run to resume again
+        """
+        token = self.dest_dataset.get_property("receive_resume_token")
+        if not token:
+            return TransferStats()
+        res = _run_cmd(
+            self.source_dataset.command(f"send -nP -t {token}"), check=False, read_only=True
+        )
+        if res.returncode != 0:
+            logging.warning(f"Unable to resume interrupted transfer: {res.stderr.decode().strip()}")
+            self.dest_dataset.abort_partial_receive()
+            return TransferStats()
+        logging.info(f"Found receive resume token on {self.dest_dataset} - resuming transfer")
+        transfer = _run_pipeline(
+            self.source_dataset.command(f"send -t {token}"),
+            *self._receive_commands(self._receive_flags(incremental=True)),
+        )
+        # The resumed stream may have completed any number of snapshots, so re-list them
+        self.dest_dataset.refresh_snapshots()
+        return transfer
+
+    def prune(self) -> dict[str, int]:
+        """Prune Source snaps not needed (and Destination if using snapshot replication)
+
+        Source and Destination are pruned concurrently, as they are usually on separate pools
+        """
         datasets = [self.source_dataset]
         if self.dest_dataset is not None:
             datasets.append(self.dest_dataset)
-        for dataset in datasets:
-            snap_names = dataset.get_snapshots(self.snap_prefix)
-            if len(snap_names) < self.options.num_snaps:
-                logging.info(f"No snapshots to prune on {dataset.name}")
-                continue
-            snaps_to_delete = list(reversed(snap_names))[self.options.num_snaps :]
-            logging.debug(f"Deleting snapshots: {snaps_to_delete}")
-            for snap_name in snaps_to_delete:
-                dataset.delete_snapshot(snap_name)
+        with ThreadPoolExecutor(max_workers=len(datasets), thread_name_prefix="prune") as pool:
+            pruned = sum(pool.map(self._prune_dataset, datasets))
+        counts = {"source_snapshots": len(self.source_dataset.get_snapshots(self.snap_prefix))}
+        if self.dest_dataset is not None:
+            counts["dest_snapshots"] = len(self.dest_dataset.get_snapshots(self.snap_prefix))
+        if self.options.bookmarks:
+            bookmarks = self.source_dataset.get_bookmarks(self.snap_prefix)
+            expired_bookmarks = list(reversed(bookmarks))[self.options.num_snaps :]
+            self.source_dataset.delete_bookmarks(expired_bookmarks)
+            pruned += len(expired_bookmarks)
+            counts["bookmarks"] = len(bookmarks) - len(expired_bookmarks)
+        return {"pruned": pruned, **counts}
+
+    def _prune_dataset(self, dataset: ZfsDataSet) -> int:
+        if dataset is self.source_dataset:
+            retention = self.source_retention
+        else:
+            retention = self.dest_retention
+        snaps_to_delete = retention.select_expired(dataset.get_snapshots(self.snap_prefix))
+        if not snaps_to_delete:
+            logging.info(f"No snapshots to prune on {dataset}")
+            return 0
+        logging.debug(f"Deleting snapshots: {snaps_to_delete}")
+        dataset.delete_snapshots(snaps_to_delete)
+        return len(snaps_to_delete)
 
     def _get_incremental_source(self, dataset: ZfsDataSet, dest_snaps: list[str]) -> str | None:
-        """Get any Candidate snap for incremenal replication"""
+        """Get any Candidate snap (or bookmark) for incremenal replication
+
+        Returned with its separator, i.e. '@snapshot' or '#bookmark'
+        """
         source_snaps = dataset.get_snapshots(self.snap_prefix)
         snaps_in_both = [snap for snap in source_snaps if snap in dest_snaps]
-        if not snaps_in_both:
+        if snaps_in_both:
+            # The best candidate will be the latest snap in the list
+            return f"@{snaps_in_both[-1]}"
+        if self.options.bookmarks:
+            bookmarks = [bm for bm in dataset.get_bookmarks(self.snap_prefix) if bm in dest_snaps]
+            if bookmarks:
+                return f"#{bookmarks[-1]}"
+        return None
+
+
+class LvmSnapshotter:
+    """Back up LVM Logical Volumes as compressed tar archives of a mounted LV snapshot"""
+
+    name: ClassVar = "lvm"
+    args: ClassVar = {
+        "--vg": {"help": "Volume group containing LV to backup"},
+        "--lv": {
+            "help": "LV To back up (can be repeated), snap name will be <lv>-backup",
+            "action": "append",
+            "default": [],
+        },
+        "--tgt": {"help": "Target backup directory for archives"},
+        "--src-path": {"help": "Path(s) to back up within snapshot", "default": "*"},
+        "--size": {"help": "LV Snap Size", "default": "5G"},
+        "--mount-base": {
+            "help": "Base path for mounting snapshot, mount point will be <mount-base>/<snap>",
+            "default": "/mnt",
+        },
+        "--num-archives": {
+            "help": "Number of archives to keep per LV",
+            "type": int,
+            "default": 3,
+        },
+    }
+
+    vg: str
+    lv: str
+    snap_lv: str
+    mount_dir: str
+
+    def __init__(self, options: Namespace) -> None:
+        self.options = options
+        self.vg = options.vg
+        self.lv = options.lv
+        self.snap_lv = f"{self.lv}-backup"
+        self.mount_dir = os.path.join(options.mount_base, self.snap_lv)
+
+    @classmethod
+    def from_options(cls, options: Namespace) -> list["LvmSnapshotter"]:
+        """Build a snapshotter per LV provided in the options"""
+        if not options.lv:
+            return []
+        if not options.vg or not options.tgt:
+            raise BackupError("--vg and --tgt are required for LVM backups")
+        return [cls(Namespace(**{**vars(options), "lv": lv})) for lv in options.lv]
+
+    @property
+    def target(self) -> str:
+        return f"{self.vg}/{self.lv} -> {self.options.tgt}"
+
+    @property
+    def locks(self) -> list[str]:
+        return [f"lvm:{self.vg}/{self.lv}"]
+
+    def plan(self) -> dict[str, Any]:
+        """Archive a run would write and prune, estimated from the previous run of the LV"""
+        archive = self._archive_path()
+        archives = [a for a in self._get_archives() if a != archive] + [archive]
+        estimated_bytes = _last_transfer_bytes(self.target)
+        return {
+            "target": self.target,
+            "snapshot": self.snap_lv,
+            "snapshot_exists": self._snapshot_exists(),
+            "archive": archive,
+            "estimated_bytes": estimated_bytes,
+            **_estimate_duration(self.target, estimated_bytes),
+            "tgt_available_bytes": (
+                shutil.disk_usage(self.options.tgt).free
+                if os.path.isdir(self.options.tgt)
+                else None
+            ),
+            "prune": {"archives": list(reversed(archives))[self.options.num_archives :]},
+        }
+
+    def recover(self, journal: RunJournal) -> str | None:
+        """Archive the snapshot left by the interrupted run again if it still exists, or just
+        clean it up if its archive was already written
+        """
+        if "snapshot" not in journal:
+            return None
+        self._unmount_snapshot()
+        if "archive" in journal or "backed_up" in journal:
+            logging.info(f"Archive {journal.get('archive')} was already written, cleaning up")
+            if self._snapshot_exists():
+                _run_cmd(f"lvremove --yes {self.vg}/{self.snap_lv}")
+            journal.record("backed_up")
+            return self.snap_lv
+        if not self._snapshot_exists():
+            logging.warning(
+                f"Snapshot {self.snap_lv} of the interrupted run is gone, starting over"
+            )
             return None
-        # The best candidate will be the latest snap in the list
-        return snaps_in_both[-1]
+        logging.info(f"Resuming backup of interrupted run from snapshot {self.snap_lv}")
+        return self.snap_lv
+
+    def create_source_snapshot(self, journal: RunJournal) -> str:
+        """Create the LV snapshot, which must not already exist"""
+        if self._snapshot_exists():
+            raise BackupError(
+                f"Snapshot {self.snap_lv} already exists and is not from an interrupted run "
+                "- manual cleanup needed"
+            )
+        logging.info(f"Taking LV snapshot: {self.vg}/{self.snap_lv}")
+        # Recorded first, so a snapshot created by a run that dies here is still cleaned up
+        journal.record("snapshot", self.snap_lv)
+        _run_cmd(
+            f"lvcreate --yes --snapshot --name {self.snap_lv} --size {self.options.size} "
+            f"{self.vg}/{self.lv}"
+        )
+        return self.snap_lv
 
+    def backup_snapshot(self, snapshot: str, journal: RunJournal) -> TransferStats:
+        """Mount the snapshot and stream a compressed archive of it to the target directory
 
-def send_discord_notification(message):
-    if WEBHOOK_URL is None:
-        logging.info("Webhook not set - skipping notification")
-        return
-    logging.info("Sending Discord Notification")
-    requests.post(
-        WEBHOOK_URL,
-        json={"username": platform.node(), "content": f"Backup Error:\n{message}"},
-    )
+        The snapshot is always unmounted and removed afterwards
+        """
+        archive = self._archive_path()
+        try:
+            self._mount_snapshot(snapshot)
+            journal.record("mounted")
+            transfer = self._write_archive(archive)
+            journal.record("archive", archive)
+        finally:
+            logging.info("Cleaning up mount point and snapshot")
+            self._unmount_snapshot()
+            _run_cmd(f"lvremove --yes {self.vg}/{snapshot}")
+        logging.info(f"Archived {self.target}: {transfer}")
+        return transfer
 
+    def prune(self) -> dict[str, int]:
+        """Remove the oldest archives for this LV, keeping --num-archives"""
+        archives = self._get_archives()
+        archives_to_delete = list(reversed(archives))[self.options.num_archives :]
+        if not archives_to_delete:
+            logging.info(f"No archives to prune for {self.lv}")
+        for archive in archives_to_delete:
+            logging.info(f"Deleting Archive: {archive}")
+            if not DRY_RUN:
+                os.remove(archive)
+                if os.path.exists(f"{archive}{CHECKSUM_SUFFIX}"):
+                    os.remove(f"{archive}{CHECKSUM_SUFFIX}")
+        return {
+            "pruned": len(archives_to_delete),
+            "archives": len(archives) - len(archives_to_delete),
+        }
+
+    def _archive_path(self) -> str:
+        date_str = datetime.now().strftime("%y_%m_%d")
+        return os.path.join(self.options.tgt, f"backup_{self.lv}_{date_str}.gz")
+
+    def _get_archives(self) -> list[str]:
+        """Archives of this LV in the target directory, oldest first
+
+        Matched exactly, so archives of other LVs sharing a name prefix (e.g. data_old for
+        data) and backup_lv.py incremental archives are never pruned with these
+        """
+        if not os.path.isdir(self.options.tgt):
+            return []
+        archive_re = re.compile(LVM_ARCHIVE_RE.format(lv=re.escape(self.lv)))
+        return sorted(
+            (
+                os.path.join(self.options.tgt, file_name)
+                for file_name in os.listdir(self.options.tgt)
+                if archive_re.match(file_name)
+            ),
+            key=os.path.getmtime,
+        )
 
-def _run_cmd(command: str, check=True, shell=False) -> subprocess.CompletedProcess:
-    if "destroy" in command and "@" not in command:
+    def _snapshot_exists(self) -> bool:
+        res = _run_cmd(f"lvs {self.vg}/{self.snap_lv}", check=False, read_only=True)
+        return res.returncode == 0
+
+    def _mount_snapshot(self, snapshot: str):
+        if not os.path.isdir(self.mount_dir):
+            logging.info("Creating backup mount dir: " + self.mount_dir)
+            os.makedirs(self.mount_dir)
+        if _get_mounted(self.mount_dir):
+            raise BackupError(
+                f"Something is already mounted at {self.mount_dir}, "
+                "possible previous failed cleanup"
+            )
+        _run_cmd(f"mount {os.path.join('/dev', self.vg, snapshot)} {self.mount_dir}")
+
+    def _unmount_snapshot(self):
+        if not _get_mounted(self.mount_dir):
+            logging.warning(f"Snapshot is not mounted at {self.mount_dir}, skipping unmount")
+            return
+        _run_cmd(f"umount {self.mount_dir}")
+
+    def _write_archive(self, archive: str) -> TransferStats:
+        """Stream tar | gzip into the archive, hashed as it is written, only replacing any
+        existing one (and its checksum file) when complete
+        """
+        if self.options.src_path == "*":
+            # Everything, including hidden files at the top level
+            src_paths = ["."]
+        else:
+            src_paths = sorted(glob.glob(self.options.src_path, root_dir=self.mount_dir))
+        if not src_paths:
+            raise BackupError(f"Nothing to back up matching {self.options.src_path}")
+        logging.info("Backing up snap to: " + archive)
+        with ChecksumFile(archive) as f:
+            transfer = _run_pipeline(
+                ["tar", "-cf", "-", "-C", self.mount_dir, "--", *src_paths], "gzip -c", output=f
+            )
+            f.commit()
+        return transfer
+
+
+def _indexed_snapshots_used(index: SizeIndex, dataset: ZfsDataSet, snapshots: list[str]) -> int:
+    """Space used only by the snapshots as of the last size sample
+
+    Destroying adjacent snapshots together can free more than this (blocks they share), so
+    it is a lower bound. Snapshots not in the index count as 0
+    """
+    used = {sample.snapshot: sample.used for sample in index.latest_snapshots(str(dataset))}
+    return sum(max(used.get(snapshot, 0), 0) for snapshot in snapshots)
+
+
+def _read_dataset_pairs(path: str, dest_host: str | None) -> list[tuple[str, str, str | None]]:
+    """Read '<src> <dest> [dest-host]' dataset pairs from a file
+
+    Blank lines and comments are ignored, dest_host is used where no host is given
+    """
+    pairs = []
+    try:
+        with open(path, "r") as f:
+            lines = f.readlines()
+    except OSError as e:
+        raise BackupError(f"Unable to read datasets file {path}: {e}")
+    for line_no, line in enumerate(lines, start=1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        fields = line.split()
+        if len(fields) not in (2, 3):
+            raise BackupError(f"Invalid dataset pair at {path}:{line_no}: {line}")
+        pairs.append((fields[0], fields[1], fields[2] if len(fields) == 3 else dest_host))
+    return pairs
+
+
+def _record_throughput(results: list[BackupResult]):
+    """Add the transfers of a run to the throughput history used for DRY_RUN estimates"""
+    history = _load_throughput_history()
+    for result in results:
+        # Small transfers are dominated by setup time, they say nothing about throughput
+        if not result.transfer or result.transfer.bytes < RELAY_CHUNK_SIZE:
+            continue
+        entries = history.setdefault(result.target, [])
+        entries.append({"time": datetime.now().isoformat(), **asdict(result.transfer)})
+        del entries[:-THROUGHPUT_HISTORY_LENGTH]
+    try:
+        os.makedirs(os.path.dirname(THROUGHPUT_HISTORY_FILE), exist_ok=True)
+        tmp_path = f"{THROUGHPUT_HISTORY_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(history, f)
+        os.replace(tmp_path, THROUGHPUT_HISTORY_FILE)
+    except OSError as e:
+        logging.warning(f"Unable to save throughput history: {e}")
+
+
+def _load_throughput_history() -> dict[str, list[dict[str, Any]]]:
+    try:
+        with open(THROUGHPUT_HISTORY_FILE, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable throughput history: {e}")
+        return {}
+
+
+def _last_transfer_bytes(target: str) -> int | None:
+    entries = _load_throughput_history().get(target)
+    return entries[-1]["bytes"] if entries else None
+
+
+def _estimate_duration(target: str, estimated_bytes: int | None) -> dict[str, Any]:
+    """Expected throughput (from the target's history, or all targets if it has none, limited
+    by the current bandwidth cap) and the resulting duration for estimated_bytes
+    """
+    history = _load_throughput_history()
+    entries = history.get(target) or [e for entries in history.values() for e in entries]
+    rate = TransferStats(sum(e["bytes"] for e in entries), sum(e["elapsed"] for e in entries)).rate
+    if THROTTLE.rate:
+        rate = min(rate, THROTTLE.rate) if rate else THROTTLE.rate
+    return {
+        "expected_bytes_per_sec": round(rate) if rate else None,
+        "estimated_seconds": round(estimated_bytes / rate) if rate and estimated_bytes else None,
+    }
+
+
+def _get_mounted(mountpoint: str) -> bool:
+    logging.debug(f"Checking for mount point: {mountpoint}")
+    with open("/proc/mounts", "r") as f:
+        for line in f.readlines():
+            if line.split()[1] == mountpoint:
+                return True
+    return False
+
+
+def _run_cmd(command: str, check=True, shell=False, read_only=False) -> subprocess.CompletedProcess:
+    """Run a command, unless DRY_RUN is set and it is not a read_only query"""
+    # Only check what is being destroyed (snapshots or bookmarks), a remote user@host may also
+    # contain an "@"
+    destroy_target = command.split("destroy", 1)[1] if "destroy" in command else ""
+    if "destroy" in command and "@" not in destroy_target and "#" not in destroy_target:
         raise BackupError(f"Destroy protection prevented running command: {command}")
     cmd = command if shell else command.split(" ")
-    if DRY_RUN:
+    if DRY_RUN and not read_only:
         logging.info(f"Dry Run - would have run: {command}")
         res = subprocess.CompletedProcess(cmd, 0, "", "")
     else:
@@ -260,5 +1493,190 @@ def _run_cmd(command: str, check=True, shell=False) -> subprocess.CompletedProce
     return res
 
 
+def _argv(command: str | list[str]) -> list[str]:
+    return command if isinstance(command, list) else command.split(" ")
+
+
+def _run_pipeline(
+    send_command: str | list[str],
+    *recv_commands: str | list[str],
+    expected_bytes: int | None = None,
+    output: ChecksumFile | None = None,
+) -> TransferStats:
+    """Run send_command | recv_commands..., relaying the send stream in-process for throughput
+
+    The stream is moved between the pipes with splice (no copy through userspace) where
+    supported, progress is logged every PROGRESS_INTERVAL seconds and stderr of every
+    process is logged as it arrives rather than at exit. The output of the last command
+    is written to output if given, hashed as it is written. Commands are split on spaces,
+    an argv list keeps arguments (e.g. paths) containing spaces intact
+    """
+    pipeline = " | ".join(shlex.join(_argv(command)) for command in [send_command, *recv_commands])
+    if DRY_RUN:
+        logging.info(f"Dry Run - would have run: {pipeline}")
+        return TransferStats()
+    logging.debug(f"Running Pipeline: {pipeline}")
+    procs: list[subprocess.Popen] = []
+    try:
+        procs.append(
+            subprocess.Popen(_argv(send_command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        )
+        stdin = subprocess.PIPE
+        for i, recv_command in enumerate(recv_commands):
+            last = i == len(recv_commands) - 1
+            procs.append(
+                subprocess.Popen(
+                    _argv(recv_command),
+                    stdin=stdin,
+                    stdout=subprocess.PIPE if output is not None or not last else None,
+                    stderr=subprocess.PIPE,
+                )
+            )
+            if stdin is not subprocess.PIPE:
+                # Now owned by the child process
+                stdin.close()
+            stdin = procs[-1].stdout
+    except OSError as e:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        raise BackupError(f"Error: Unable to start pipeline: {e}")
+    send = procs[0]
+    stderr_tails = {proc: deque(maxlen=10) for proc in procs}
+    log_threads = [
+        threading.Thread(
+            target=_log_stream, args=(_command_label(proc.args), proc.stderr, tail), daemon=True
+        )
+        for proc, tail in stderr_tails.items()
+    ]
+    output_errors: list[OSError] = []
+    if output is not None:
+        log_threads.append(
+            threading.Thread(
+                target=_write_output,
+                args=(procs[-1].stdout, output, output_errors),
+                daemon=True,
+            )
+        )
+    for thread in log_threads:
+        thread.start()
+    progress = _RelayProgress(_command_label(send.args), expected_bytes)
+    progress.start()
+    try:
+        _relay(send.stdout, procs[1].stdin, progress)
+    finally:
+        progress.stop()
+        send.stdout.close()
+        procs[1].stdin.close()
+        for proc in procs:
+            proc.wait()
+        for thread in log_threads:
+            thread.join()
+    if output_errors:
+        raise BackupError(f"Error: Unable to write output: {output_errors[0]}")
+    failed = [proc for proc in procs if proc.returncode != 0]
+    if failed:
+        # One process failing usually takes the others down too (e.g. SIGPIPE), so report all
+        stderr = "\n".join(line for proc in failed for line in stderr_tails[proc])
+        return_code = next((proc.returncode for proc in failed if proc.returncode > 0), 1)
+        raise BackupError(f"Error: {stderr}", return_code=return_code)
+    stats = TransferStats(progress.bytes, time.monotonic() - progress.started)
+    logging.debug(f"Pipeline complete: {stats}")
+    return stats
+
+
+def _relay(src: IO[bytes], dest: IO[bytes], progress: "_RelayProgress"):
+    """Copy src to dest until EOF, counting bytes moved and keeping to the bandwidth cap"""
+    for pipe in (src, dest):
+        try:
+            fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, RELAY_CHUNK_SIZE)
+        except OSError:
+            # Limited by /proc/sys/fs/pipe-max-size for non-root, default size works too
+            pass
+    try:
+        while n := os.splice(src.fileno(), dest.fileno(), THROTTLE.chunk_size(RELAY_CHUNK_SIZE)):
+            progress.bytes += n
+            THROTTLE.consume(n)
+        return
+    except BrokenPipeError:
+        # Receiver exited early, its exit code and stderr tell the story
+        return
+    except OSError:
+        logging.debug("splice not supported for this stream, falling back to buffered copy")
+    buf = memoryview(bytearray(RELAY_CHUNK_SIZE))
+    try:
+        while n := src.readinto(buf[: THROTTLE.chunk_size(RELAY_CHUNK_SIZE)]):
+            dest.write(buf[:n])
+            progress.bytes += n
+            THROTTLE.consume(n)
+    except BrokenPipeError:
+        return
+
+
+class _RelayProgress(threading.Thread):
+    """Periodically log bytes relayed and current rate, warning when the stream stalls"""
+
+    def __init__(self, name: str, expected_bytes: int | None = None) -> None:
+        super().__init__(daemon=True)
+        self.label = name
+        self.expected_bytes = expected_bytes
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._stopped = threading.Event()
+
+    def run(self):
+        last_bytes, last_time = 0, self.started
+        while not self._stopped.wait(PROGRESS_INTERVAL):
+            now, total = time.monotonic(), self.bytes
+            interval = TransferStats(total - last_bytes, now - last_time)
+            if not interval.bytes:
+                logging.warning(f"{self.label}: no data moved in the last {interval.elapsed:.0f}s")
+            else:
+                sent = _format_bytes(total)
+                if self.expected_bytes:
+                    sent += f" of {_format_bytes(self.expected_bytes)}"
+                    sent += f" ({min(100 * total / self.expected_bytes, 100):.0f}%)"
+                logging.info(
+                    f"{self.label}: {sent} sent, currently {_format_bytes(interval.rate)}/s"
+                )
+            last_bytes, last_time = total, now
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _log_stream(prefix: str, stream: IO[bytes], tail: deque):
+    """Log each line of a child process output stream as it arrives, keeping the last few"""
+    for raw_line in stream:
+        line = raw_line.decode(errors="replace").rstrip()
+        tail.append(line)
+        logging.info(f"{prefix}: {line}")
+    stream.close()
+
+
+def _write_output(stream: IO[bytes], output: ChecksumFile, errors: list[OSError]):
+    """Copy the output of the last pipeline command to output, recording any write error"""
+    try:
+        output.copy_from(stream)
+    except OSError as e:
+        errors.append(e)
+    # Closing the pipe early stops the command blocking on writes nobody will read
+    stream.close()
+
+
+def _command_label(args: list[str]) -> str:
+    """Short name for a command in log messages, leaving out any ssh options"""
+    return " ".join(args).replace(f" {SSH_OPTIONS}", "")
+
+
+def _format_bytes(num: float) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if num < 1024 or unit == "TiB":
+            break
+        num /= 1024
+    return f"{num:.1f} {unit}"
+
+
 if __name__ == "__main__":
     sys.exit(main())
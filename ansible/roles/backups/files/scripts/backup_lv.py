@@ -1,18 +1,45 @@
 #!/usr/bin/env python3
 import logging
 import os
-import platform
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
 from argparse import ArgumentParser
-from datetime import date
+from datetime import date, datetime
 
-import requests
+from checksum import ChecksumError, ChecksumFile, verify_archive
+from chunkstore import ChunkStore
+from metrics import Metrics
+from notify import Notifier
+from runjournal import RunJournal, RunLockedError
+from throttle import Throttle, add_throttle_arguments, apply_throttle_options
 
 _truthy_strs = ["true", "1", "y", "yes"]
 DEBUG = os.getenv("DEBUG", "").lower() in _truthy_strs
 DRY_RUN = os.getenv("DRY_RUN", "").lower() in _truthy_strs
-WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Compression engines: (archive extension, compressor command with {level}/{threads})
+COMPRESSION_ENGINES = {
+    "gzip": (".gz", "gzip -{level}"),
+    "pigz": (".gz", "pigz -{level} -p {threads}"),
+    "zstd": (".zst", "zstd -q -{level} -T{threads}"),
+    "none": (".tar", None),
+}
+DEFAULT_COMPRESSION_LEVELS = {"gzip": 6, "pigz": 6, "zstd": 3}
+# Incremental archives are named backup_<lv>_<date>_<full|inc><extension>, anchored to the
+# archive extensions so checksum sidecars and partial archives never match
+INCREMENTAL_DATE_FMT = "%y_%m_%d_%H%M%S"
+INCREMENTAL_ARCHIVE_RE = (
+    r"backup_{lv}_(?P<date>\d{{2}}_\d{{2}}_\d{{2}}_\d{{6}})_(?P<level>full|inc)"
+    r"\.(?:gz|zst|tar)$"
+)
+
+
+METRICS = Metrics("backup_lv")
+NOTIFIER = Notifier("backup_lv")
+THROTTLE = Throttle()
 
 
 class BackupError(RuntimeError):
@@ -32,9 +59,60 @@ def main():
         default="/mnt",
         help="Base path for mounting snapshot. Actual mount point will be <mount-base>/<snap>",
     )
+    p.add_argument(
+        "-z",
+        "--compression",
+        choices=COMPRESSION_ENGINES,
+        default="gzip",
+        help="Compression engine, pigz and zstd use multiple threads (Default: %(default)s)",
+    )
+    p.add_argument("--compression-level", type=int, help="Compression level (engine default)")
+    p.add_argument(
+        "--threads",
+        type=int,
+        default=os.cpu_count(),
+        help="Compression threads for pigz/zstd (Default: %(default)s)",
+    )
+    p.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="Compress a sample of the snapshot with each engine and report speed/ratio only",
+    )
+    p.add_argument(
+        "--benchmark-mb",
+        type=int,
+        default=256,
+        help="Size of the snapshot sample for --benchmark in MB (Default: %(default)s)",
+    )
+    p.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Archive only files changed since the last full archive, which is taken periodically",
+    )
+    p.add_argument(
+        "--full-every",
+        type=int,
+        default=7,
+        help="Days between full archives in incremental mode (Default: %(default)s)",
+    )
+    p.add_argument(
+        "--restore",
+        metavar="DEST",
+        help="Restore the latest full archive and increment for the LV into DEST",
+    )
+    p.add_argument(
+        "--chunk-store",
+        metavar="DIR",
+        help="Store the archive in a deduplicating chunk store instead of a file in --tgt",
+    )
     p.add_argument("-c", "--cleanup", action="store_true", help="Run cleanup only")
     p.add_argument("-f", "--log-file", help="Output Log file")
+    add_throttle_arguments(p)
     opts = p.parse_args()
+    if opts.chunk_store and (opts.incremental or opts.restore):
+        # Unchanged data is already deduplicated against previous full archives
+        p.error("--chunk-store takes full archives, restore with chunkstore.py")
 
     logging.basicConfig(
         level=logging.DEBUG if DEBUG else logging.INFO,
@@ -42,43 +120,144 @@ def main():
         datefmt="%Y-%m-%d %H:%M:%S",
         filename=opts.log_file,
     )
+    apply_throttle_options(opts, THROTTLE)
 
     if not DRY_RUN and os.geteuid() != 0:
         raise PermissionError("Root permissions needed for LVM Snapshots")
 
+    METRICS.tags.update({"type": "lvm", "target": f"{opts.vg}/{opts.lv} -> {opts.tgt}"})
     snap_lv = opts.lv + "-backup"
     date_str = date.today().strftime("%y_%m_%d")
     snap_mount_dir = os.path.join(opts.mount_base, snap_lv)
-    backup_file_name = os.path.join(opts.tgt, f"backup_{opts.lv}_{date_str}.gz")
+    extension = COMPRESSION_ENGINES[opts.compression][0]
+    backup_file_name = os.path.join(opts.tgt, f"backup_{opts.lv}_{date_str}{extension}")
+    # Incremental state (tar snapshot file) as of the last full archive, every increment is
+    # based on it (level 1), so a restore needs only the full and the latest increment
+    snar_file = os.path.join(opts.tgt, f"backup_{opts.lv}.snar.0")
+    if opts.incremental:
+        backup_level = get_backup_level(opts.tgt, opts.lv, snar_file, opts.full_every)
+        # More than one archive a day is possible, each is needed to restore the chain
+        date_str = datetime.now().strftime(INCREMENTAL_DATE_FMT)
+        backup_file_name = os.path.join(
+            opts.tgt, f"backup_{opts.lv}_{date_str}_{backup_level}{extension}"
+        )
 
-    if opts.cleanup:
-        logging.info("Running Snapshot and MP Cleanup")
-        unmount_snap(snap_mount_dir)
-        remove_snap(opts.vg, snap_lv)
+    if opts.restore:
+        restore_incremental(opts.tgt, opts.lv, opts.restore)
         return 0
 
-    if not os.path.isdir(snap_mount_dir):
-        logging.info("Creating backup mount dir: " + snap_mount_dir)
-        os.mkdir(snap_mount_dir)
-
-    check_snap_res = check_snap_lv(opts.vg, snap_lv)
-    if check_snap_res.returncode == 5 or DRY_RUN:
-        logging.info("No Existing Snapshot found - continuing with backup")
-    elif check_snap_res.returncode == 0:
-        raise BackupError(f"Snapshot {snap_lv} already exists - manual cleanup needed")
-    else:
-        raise BackupError(f"Error getting Snapshot: {check_snap_res.returncode}")
-
-    create_snap(opts.vg, opts.lv, snap_lv, opts.size)
+    # Same target and lock as backup.py uses for the LV, so the two scripts never overlap either
     try:
-        mount_snap(opts.vg, snap_lv, snap_mount_dir)
-        tar_backup(snap_mount_dir, opts.src_path, backup_file_name)
-    finally:
-        logging.info("Cleaning up mount point and snapshot")
-        # Note unmount is idempotent, if the snap was never mounted it will not fail
-        unmount_snap(snap_mount_dir)
-        remove_snap(opts.vg, snap_lv)
-    return 1
+        with RunJournal(
+            f"{opts.vg}/{opts.lv} -> {opts.tgt}", locks=[f"lvm:{opts.vg}/{opts.lv}"]
+        ) as journal:
+            if opts.cleanup:
+                logging.info("Running Snapshot and MP Cleanup")
+                unmount_snap(snap_mount_dir)
+                remove_snap(opts.vg, snap_lv)
+                journal.complete()
+                return 0
+            resume = journal.interrupted and recover_interrupted(
+                opts.vg, snap_lv, snap_mount_dir, journal
+            )
+            if not os.path.isdir(snap_mount_dir):
+                logging.info("Creating backup mount dir: " + snap_mount_dir)
+                os.mkdir(snap_mount_dir)
+
+            if resume:
+                logging.info(f"Resuming from existing snapshot {snap_lv} of the interrupted run")
+            else:
+                check_snap_res = check_snap_lv(opts.vg, snap_lv)
+                if check_snap_res.returncode == 5 or DRY_RUN:
+                    logging.info("No Existing Snapshot found - continuing with backup")
+                elif check_snap_res.returncode == 0:
+                    raise BackupError(
+                        f"Snapshot {snap_lv} already exists and is not from an interrupted run "
+                        "- manual cleanup needed"
+                    )
+                else:
+                    raise BackupError(f"Error getting Snapshot: {check_snap_res.returncode}")
+                # Recorded first, so a snapshot created by a run that dies here is still cleaned up
+                journal.record("snapshot", snap_lv)
+                with METRICS.phase("snapshot"):
+                    create_snap(opts.vg, opts.lv, snap_lv, opts.size)
+
+            try:
+                mount_snap(opts.vg, snap_lv, snap_mount_dir)
+                journal.record("mounted")
+                with METRICS.phase("archive") as phase:
+                    if opts.benchmark:
+                        archive_bytes = None
+                        benchmark_compression(
+                            snap_mount_dir,
+                            opts.benchmark_mb * 1000**2,
+                            opts.compression_level,
+                            opts.threads,
+                        )
+                    elif opts.incremental:
+                        archive_bytes = incremental_tar_backup(
+                            snap_mount_dir,
+                            opts.src_path,
+                            backup_file_name,
+                            snar_file,
+                            backup_level,
+                            opts.compression,
+                            opts.compression_level,
+                            opts.threads,
+                        )
+                    elif opts.chunk_store:
+                        archive_bytes = chunk_store_backup(
+                            snap_mount_dir,
+                            opts.src_path,
+                            opts.chunk_store,
+                            f"backup_{opts.lv}_{date_str}",
+                        )
+                    else:
+                        archive_bytes = tar_backup(
+                            snap_mount_dir,
+                            opts.src_path,
+                            backup_file_name,
+                            opts.compression,
+                            opts.compression_level,
+                            opts.threads,
+                        )
+                    phase["bytes"] = archive_bytes
+                if not opts.benchmark:
+                    journal.record("archive", backup_file_name)
+            finally:
+                logging.info("Cleaning up mount point and snapshot")
+                with METRICS.phase("cleanup"):
+                    # Note unmount is idempotent, if the snap was never mounted it will not fail
+                    unmount_snap(snap_mount_dir)
+                    remove_snap(opts.vg, snap_lv)
+            journal.complete()
+            if opts.benchmark:
+                # Nothing was archived, so there is no backup to report
+                return 0
+            NOTIFIER.success(f"{opts.vg}/{opts.lv} backed up to {opts.tgt}")
+    except RunLockedError as e:
+        logging.warning(f"{e} - skipping")
+    return 0
+
+
+def recover_interrupted(vg, snap_lv, mountpoint, journal):
+    """Clean up after an interrupted run, returns True if its snapshot can be resumed from
+
+    The mount is always undone, the snapshot is only kept if its archive was not written
+    """
+    unmount_snap(mountpoint)
+    snap_exists = not DRY_RUN and check_snap_lv(vg, snap_lv).returncode == 0
+    if "archive" in journal:
+        logging.info(f"Archive {journal.get('archive')} of the interrupted run was written")
+        if snap_exists:
+            remove_snap(vg, snap_lv)
+        journal.complete()
+        return False
+    if not snap_exists:
+        logging.warning(f"Snapshot {snap_lv} of the interrupted run is gone, starting over")
+        journal.complete()
+        return False
+    return True
 
 
 def check_snap_lv(vg, snap_name):
@@ -105,9 +284,155 @@ def create_snap(vg, lv, snap, size):
     )
 
 
-def tar_backup(mountpoint, sub_path, target):
-    cmd_backup_snap = ["tar", "czf", target, "-C", mountpoint, sub_path]
-    return _run_cmd(cmd_backup_snap, check=True)
+def tar_backup(
+    mountpoint, sub_path, target, compression="gzip", level=None, threads=1, snar_file=None
+):
+    cmd_backup_snap = ["tar", *_compress_args(compression, level, threads)]
+    if snar_file:
+        # Each snapshot mount gets a new device number, which must not count as a change
+        cmd_backup_snap += ["--listed-incremental", snar_file, "--no-check-device"]
+    cmd_backup_snap += ["-cf", "-", "-C", mountpoint, sub_path]
+    if DRY_RUN:
+        logging.info(f"DRY_RUN - Would have executed: '{' '.join(cmd_backup_snap)}' > {target}")
+        return
+    # Hashed as it is written, an archive only replaces target (with its checksum file) once
+    # tar has completed successfully
+    logging.debug(f"Running command: '{' '.join(cmd_backup_snap)}' > {target}")
+    with ChecksumFile(target) as archive:
+        proc = subprocess.Popen(cmd_backup_snap, stdout=subprocess.PIPE)
+        try:
+            archive.copy_from(THROTTLE.reader(proc.stdout))
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd_backup_snap)
+        archive.commit()
+    return archive.bytes
+
+
+def chunk_store_backup(mountpoint, sub_path, store_path, name):
+    """Stream an uncompressed tar of the snapshot into the chunk store as backup name,
+    chunks are compressed individually so unchanged data deduplicates between runs
+    """
+    cmd_backup_snap = ["tar", "-cf", "-", "-C", mountpoint, sub_path]
+    if DRY_RUN:
+        logging.info(f"DRY_RUN - Would have stored '{' '.join(cmd_backup_snap)}' as {name}")
+        return
+    logging.debug(f"Running command: '{' '.join(cmd_backup_snap)}'")
+    store = ChunkStore(store_path)
+    proc = subprocess.Popen(cmd_backup_snap, stdout=subprocess.PIPE)
+    try:
+        stats = store.store(name, THROTTLE.reader(proc.stdout))
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        # The stream was cut short, do not keep it as a complete backup
+        store.delete(name)
+        raise BackupError(f"tar failed with exit code {proc.returncode}")
+    return stats.bytes
+
+
+def get_backup_level(tgt, lv, snar_file, full_every_days):
+    """Get "full" if there is no incremental state or the last full is too old, else "inc" """
+    full_archives = [date for date, level, _ in _incremental_archives(tgt, lv) if level == "full"]
+    if not os.path.exists(snar_file) or not full_archives:
+        logging.info("No incremental state found, taking a full archive")
+        return "full"
+    full_age_days = (datetime.now() - full_archives[-1]).total_seconds() / 86400
+    if full_age_days >= full_every_days:
+        logging.info(f"Last full archive is {full_age_days:.1f} days old, taking a full archive")
+        return "full"
+    return "inc"
+
+
+def incremental_tar_backup(
+    mountpoint, sub_path, target, snar_file, backup_level, compression, level, threads
+):
+    """Archive files changed since the last full archive (or all for a "full")
+
+    tar updates the state file in place, so it always works on a copy. Only a complete full
+    archive replaces the saved state, increments discard theirs and stay level 1. A failed
+    run can simply be re-run
+    """
+    work_snar = f"{snar_file}.work"
+    if backup_level == "full":
+        if os.path.exists(work_snar):
+            os.remove(work_snar)
+    else:
+        shutil.copy2(snar_file, work_snar)
+    try:
+        archive_bytes = tar_backup(
+            mountpoint, sub_path, target, compression, level, threads, work_snar
+        )
+        if backup_level == "full" and not DRY_RUN:
+            os.replace(work_snar, snar_file)
+    finally:
+        if os.path.exists(work_snar):
+            os.remove(work_snar)
+    return archive_bytes
+
+
+def restore_incremental(tgt, lv, dest):
+    """Extract the latest full archive of lv and then the latest increment on top of it
+
+    Increments are level 1, each holds every change since the full archive
+    """
+    archives = _incremental_archives(tgt, lv)
+    full_idxs = [idx for idx, (_, level, _) in enumerate(archives) if level == "full"]
+    if not full_idxs:
+        raise BackupError(f"No full archive found for {lv} in {tgt}")
+    chain = [archives[full_idxs[-1]][2]]
+    if full_idxs[-1] < len(archives) - 1:
+        chain.append(archives[-1][2])
+    # Check the whole chain against the checksum files first, rather than stopping part way
+    # through a restore on a corrupt archive
+    for archive in chain:
+        try:
+            verify_archive(archive)
+        except ChecksumError as e:
+            raise BackupError(f"Archive {archive} failed verification, not restoring: {e}")
+    os.makedirs(dest, exist_ok=True)
+    for archive in chain:
+        logging.info(f"Restoring {archive} to {dest}")
+        # An incremental extract also removes files that were deleted before that archive
+        _run_cmd(["tar", "--listed-incremental=/dev/null", "-xf", archive, "-C", dest], check=True)
+
+
+def benchmark_compression(mountpoint, sample_bytes, level=None, threads=1):
+    """Archive a sample of the files under mountpoint with each compression engine,
+    reporting throughput (of uncompressed data) and compression ratio
+    """
+    sample_files, sample_size = _sample_files(mountpoint, sample_bytes)
+    if not sample_files:
+        logging.warning(f"No files to sample under {mountpoint}")
+        return
+    logging.info(f"Benchmarking with {len(sample_files)} files, {sample_size / 1000**2:.1f}MB")
+    with tempfile.NamedTemporaryFile("w") as file_list:
+        file_list.write("\0".join(sample_files))
+        file_list.flush()
+        # The first (uncompressed) pass also warms the page cache for a fair comparison
+        for engine in ["none", *(e for e in COMPRESSION_ENGINES if e != "none")]:
+            compress_cmd = COMPRESSION_ENGINES[engine][1]
+            if compress_cmd and not shutil.which(compress_cmd.split(" ")[0]):
+                logging.info(f"{engine:>5}: not installed, skipping")
+                continue
+            cmd = ["tar", *_compress_args(engine, level, threads), "-cf", "-", "-C", mountpoint]
+            cmd += ["--null", "-T", file_list.name]
+            start = time.monotonic()
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            output_size = 0
+            while chunk := proc.stdout.read(1024**2):
+                output_size += len(chunk)
+            if proc.wait() != 0:
+                logging.error(f"{engine:>5}: failed with exit code {proc.returncode}")
+                continue
+            elapsed = time.monotonic() - start
+            logging.info(
+                f"{engine:>5}: {sample_size / 1000**2 / elapsed:8.1f} MB/s, "
+                f"ratio {sample_size / max(output_size, 1):.2f}"
+            )
 
 
 def mount_snap(vg, snap_lv, mountpoint):
@@ -129,15 +454,40 @@ def remove_snap(vg, snap_lv):
     return _run_cmd(["lvremove", "--yes", f"{vg}/{snap_lv}"], check=True)
 
 
-def send_discord_notification(message):
-    if WEBHOOK_URL is None:
-        logging.info("Webhook not set - skipping notification")
-        return
-    logging.info("Sending Discord Notification")
-    requests.post(
-        WEBHOOK_URL,
-        json={"username": platform.node(), "content": f"Backup Error:\n{message}"},
-    )
+def _incremental_archives(tgt, lv):
+    """Get (date, level, path) of the incremental mode archives of lv, oldest first"""
+    archive_re = re.compile(INCREMENTAL_ARCHIVE_RE.format(lv=re.escape(lv)))
+    archives = []
+    for file_name in os.listdir(tgt) if os.path.isdir(tgt) else []:
+        if match := archive_re.match(file_name):
+            archive_date = datetime.strptime(match.group("date"), INCREMENTAL_DATE_FMT)
+            archives.append((archive_date, match.group("level"), os.path.join(tgt, file_name)))
+    return sorted(archives)
+
+
+def _compress_args(compression, level, threads):
+    """tar arguments to compress the archive with the selected engine"""
+    compress_cmd = COMPRESSION_ENGINES[compression][1]
+    if compress_cmd is None:
+        return []
+    level = level if level is not None else DEFAULT_COMPRESSION_LEVELS[compression]
+    return ["-I", compress_cmd.format(level=level, threads=threads)]
+
+
+def _sample_files(mountpoint, sample_bytes):
+    """Pick regular files under mountpoint (relative paths) until sample_bytes are covered"""
+    sample_files, sample_size = [], 0
+    for dir_path, dir_names, file_names in os.walk(mountpoint):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            path = os.path.join(dir_path, file_name)
+            if not os.path.isfile(path) or os.path.islink(path):
+                continue
+            sample_files.append(os.path.relpath(path, mountpoint))
+            sample_size += os.path.getsize(path)
+            if sample_size >= sample_bytes:
+                return sample_files, sample_size
+    return sample_files, sample_size
 
 
 def _get_mounted(mountpoint):
@@ -159,9 +509,16 @@ def _run_cmd(cmd_args, **kwargs):
 
 if __name__ == "__main__":
     res = 1
+    start = time.monotonic()
     try:
         res = main()
     except Exception as e:
-        send_discord_notification(e)
+        NOTIFIER.error(str(e))
         logging.exception(e)
+    METRICS.add(
+        "backup_run", {"ok": res == 0, "return_code": res, "duration_s": time.monotonic() - start}
+    )
+    METRICS.flush()
+    # Also sends anything left in the spool by earlier runs
+    NOTIFIER.flush()
     sys.exit(res)
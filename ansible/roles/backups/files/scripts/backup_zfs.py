@@ -2,43 +2,111 @@
 import os
 import subprocess
 import sys
+import time
 from argparse import ArgumentParser
 from datetime import date
 
+from checksum import ChecksumFile
+from chunkstore import ChunkStore
+from metrics import Metrics
+from throttle import Throttle, add_throttle_arguments, apply_throttle_options
+
+METRICS = Metrics("backup_zfs")
+THROTTLE = Throttle()
+
 
 def main():
     p = ArgumentParser()
     p.add_argument("--dataset", required=True, help="ZFS Dataset to backup")
-    p.add_argument("--tgt", required=True, help="Target backup directory")
+    p.add_argument("--tgt", help="Target backup directory")
+    p.add_argument("--chunk-store", help="Deduplicating chunk store directory, instead of --tgt")
+    add_throttle_arguments(p)
     opts = p.parse_args()
+    if not opts.tgt and not opts.chunk_store:
+        p.error("one of --tgt or --chunk-store is required")
+    apply_throttle_options(opts, THROTTLE)
 
+    METRICS.tags.update({"type": "zfs", "target": opts.dataset})
     date_str = date.today().strftime("%y_%m_%d")
     snap_name = opts.dataset + "@backup_" + date_str
-    backup_file_name = f"{opts.tgt}/zfsbackup_{opts.dataset.replace('/', '_')}_{date_str}.gz"
+    backup_name = f"zfsbackup_{opts.dataset.replace('/', '_')}_{date_str}"
+    backup_file_name = f"{opts.tgt}/{backup_name}.gz"
 
     # Check root perms
     if os.geteuid() != 0:
         print("ERROR: Root permissions needed for ZFS Snapshots")
         return 1
 
-    if not os.path.isdir(opts.tgt):
+    if opts.tgt and not os.path.isdir(opts.tgt):
         print("Creating backup dir: " + opts.tgt)
         os.mkdir(opts.tgt)
 
     print("Taking zfs snapshot: " + snap_name)
     cmd_est_snap = ["zfs", "snap", "-r", snap_name]
-    subprocess.check_call(cmd_est_snap)
+    with METRICS.phase("snapshot"):
+        subprocess.check_call(cmd_est_snap)
 
-    print("Backing up snap to: " + backup_file_name)
-    cmd_backup_snap = f"zfs send -R {snap_name} | pv | gzip > {backup_file_name}"
     try:
-        subprocess.check_call(cmd_backup_snap, shell=True)
+        with METRICS.phase("send") as phase:
+            if opts.chunk_store:
+                print(f"Backing up snap to chunk store: {opts.chunk_store} as {backup_name}")
+                phase["bytes"] = store_stream(
+                    f"zfs send -R {snap_name} | pv", opts.chunk_store, backup_name
+                )
+            else:
+                print("Backing up snap to: " + backup_file_name)
+                phase["bytes"] = write_stream(
+                    f"zfs send -R {snap_name} | pv | gzip", backup_file_name
+                )
     finally:
         print("Removing snapshot")
         cmd_rem_snap = ["zfs", "destroy", "-r", snap_name]
-        subprocess.check_call(cmd_rem_snap)
+        with METRICS.phase("cleanup"):
+            subprocess.check_call(cmd_rem_snap)
     return 0
 
 
+def write_stream(cmd, path):
+    """Write the output of a shell command to path, with a checksum file made as it is written"""
+    with ChecksumFile(path) as archive:
+        proc = subprocess.Popen(["bash", "-o", "pipefail", "-c", cmd], stdout=subprocess.PIPE)
+        try:
+            archive.copy_from(THROTTLE.reader(proc.stdout))
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        print(f"Wrote {path} with sha256 {archive.commit()}")
+    return archive.bytes
+
+
+def store_stream(cmd, store_path, name):
+    """Store the output of a shell command in the chunk store as backup name"""
+    store = ChunkStore(store_path)
+    # pipefail, so a failed zfs send is not hidden by pv exiting cleanly
+    proc = subprocess.Popen(["bash", "-o", "pipefail", "-c", cmd], stdout=subprocess.PIPE)
+    try:
+        stats = store.store(name, THROTTLE.reader(proc.stdout))
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        # Incomplete stream, do not keep it as a backup
+        store.delete(name)
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return stats.bytes
+
+
 if __name__ == "__main__":
-    sys.exit(main())
+    res = 1
+    start = time.monotonic()
+    try:
+        res = main()
+    finally:
+        METRICS.add(
+            "backup_run",
+            {"ok": res == 0, "return_code": res, "duration_s": time.monotonic() - start},
+        )
+        METRICS.flush()
+    sys.exit(res)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Checksummed archive writing and verification for the backup scripts
+
+Archives are hashed as they are written (no second read) and get a sha256sum compatible
+sidecar file, "verify" re-reads archives to check both the checksum and that the
+compressed stream is intact, at idle I/O priority so it does not slow down live backups.
+"""
+
+import hashlib
+import logging
+import os
+import subprocess
+import sys
+import zlib
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO
+
+from throttle import set_priority
+
+_truthy_strs = ["true", "1", "y", "yes"]
+DEBUG = os.getenv("DEBUG", "").lower() in _truthy_strs
+
+CHECKSUM_SUFFIX = ".sha256"
+READ_SIZE = 8 * 1024 * 1024
+ARCHIVE_SUFFIXES = (".gz", ".zst", ".tar")
+
+
+def main():
+    p = ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("-f", "--log-file", help="Output Log file")
+    sub = p.add_subparsers(dest="command", required=True)
+    verify_p = sub.add_parser("verify", help="Verify archives, or all archives in directories")
+    verify_p.add_argument("paths", nargs="+", help="Archive files or directories")
+    verify_p.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=2,
+        help="Archives to verify at once (Default: %(default)s)",
+    )
+    verify_p.add_argument(
+        "--no-idle", action="store_true", help="Do not drop to idle I/O and low CPU priority"
+    )
+    opts = p.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if DEBUG else logging.INFO,
+        format="[%(asctime)s] [%(levelname)8s] [%(funcName)12.12s()] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        filename=opts.log_file,
+    )
+    if not opts.no_idle:
+        # Set before any worker threads start, they inherit the priority
+        set_priority("idle", nice=10)
+    archives = _find_archives(opts.paths)
+    if not archives:
+        logging.error("No archives found to verify")
+        return 1
+    failures = verify_archives(archives, opts.jobs)
+    logging.info(f"Verified {len(archives)} archives, {len(failures)} failed")
+    return 1 if failures else 0
+
+
+class ChecksumError(RuntimeError):
+    """Archive failed verification"""
+
+
+class ChecksumFile:
+    """Write an archive via a .partial file, hashing it as it is written
+
+    commit() moves the archive into place with its checksum sidecar, leaving the context
+    without committing discards the partial archive
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.partial_path = f"{path}.partial"
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+        self._file: IO[bytes] | None = None
+
+    def __enter__(self) -> "ChecksumFile":
+        self._file = open(self.partial_path, "wb")
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.partial_path)
+
+    def write(self, data: bytes | memoryview):
+        self.sha256.update(data)
+        self._file.write(data)
+        self.bytes += len(data)
+
+    def copy_from(self, stream: IO[bytes]):
+        """Write everything from stream until EOF"""
+        buf = memoryview(bytearray(READ_SIZE))
+        while n := stream.readinto(buf):
+            self.write(buf[:n])
+
+    def commit(self) -> str:
+        """Sync and move the archive and its sidecar into place, returns the hex digest"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        digest = self.sha256.hexdigest()
+        os.replace(self.partial_path, self.path)
+        write_sidecar(self.path, digest)
+        logging.info(f"Wrote {self.path}: {self.bytes} bytes, sha256 {digest}")
+        return digest
+
+
+def write_sidecar(path: str, digest: str):
+    """Write the checksum file for path, in the format used by sha256sum -c"""
+    tmp_path = f"{path}{CHECKSUM_SUFFIX}.partial"
+    with open(tmp_path, "w") as f:
+        f.write(f"{digest}  {os.path.basename(path)}\n")
+    os.replace(tmp_path, f"{path}{CHECKSUM_SUFFIX}")
+
+
+def read_sidecar(path: str) -> str | None:
+    try:
+        with open(f"{path}{CHECKSUM_SUFFIX}", "r") as f:
+            return f.read().split()[0]
+    except (FileNotFoundError, IndexError):
+        return None
+
+
+def verify_archives(archives: list[str], jobs: int) -> list[str]:
+    """Verify archives concurrently, returns those that failed"""
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="verify") as pool:
+        results = list(pool.map(_verify_logged, archives))
+    return [archive for archive, ok in zip(archives, results) if not ok]
+
+
+def verify_archive(path: str):
+    """Check the sha256 sidecar and compression integrity of an archive in one read pass
+
+    gzip is checked in-process (zlib releases the GIL), zstd is streamed to zstd -t
+    """
+    expected = read_sidecar(path)
+    if expected is None:
+        logging.warning(f"No checksum file for {path}, checking compression only")
+    sha256 = hashlib.sha256()
+    checker = _compression_checker(path)
+    with open(path, "rb", buffering=0) as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buf = memoryview(bytearray(READ_SIZE))
+        offset = 0
+        while n := f.readinto(buf):
+            sha256.update(buf[:n])
+            checker.send(buf[:n])
+            # Verified data is not needed again, keep the page cache for live backups
+            os.posix_fadvise(f.fileno(), offset, n, os.POSIX_FADV_DONTNEED)
+            offset += n
+    if not offset:
+        raise ChecksumError("Empty archive")
+    try:
+        checker.send(None)
+    except StopIteration:
+        pass
+    if expected is not None and sha256.hexdigest() != expected:
+        raise ChecksumError(f"Checksum mismatch, expected {expected} got {sha256.hexdigest()}")
+
+
+def _verify_logged(path: str) -> bool:
+    try:
+        verify_archive(path)
+    except (ChecksumError, OSError) as e:
+        logging.error(f"{path}: FAILED - {e}")
+        return False
+    logging.info(f"{path}: OK")
+    return True
+
+
+def _compression_checker(path: str):
+    """Generator consuming archive data (None at EOF), raising ChecksumError if corrupt"""
+    if path.endswith(".gz"):
+        checker = _gzip_checker()
+    elif path.endswith(".zst"):
+        checker = _command_checker(["zstd", "-t", "-q", "-"])
+    else:
+        checker = _tar_checker()
+    next(checker)
+    return checker
+
+
+def _gzip_checker():
+    # Archives may hold several gzip members (e.g. concatenated or pigz), check them all
+    decompressor, in_member = zlib.decompressobj(wbits=47), False
+    while (data := (yield)) is not None:
+        try:
+            while data:
+                in_member = True
+                decompressor.decompress(data, READ_SIZE)
+                data = decompressor.unconsumed_tail
+                if decompressor.eof:
+                    data = decompressor.unused_data + data
+                    decompressor, in_member = zlib.decompressobj(wbits=47), False
+        except zlib.error as e:
+            raise ChecksumError(f"Corrupt gzip stream: {e}")
+    if in_member:
+        raise ChecksumError("Truncated gzip stream")
+
+
+def _command_checker(cmd: list[str]):
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    broken_pipe = False
+    try:
+        while (data := (yield)) is not None:
+            if broken_pipe:
+                # The checker has already given up, its exit code says why
+                continue
+            try:
+                proc.stdin.write(data)
+            except BrokenPipeError:
+                broken_pipe = True
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        stderr = proc.stderr.read().decode().strip()
+        if proc.wait() != 0:
+            raise ChecksumError(f"{cmd[0]} check failed: {stderr}")
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+
+def _tar_checker():
+    # Uncompressed tar archives are always a whole number of 512 byte blocks
+    size = 0
+    while (data := (yield)) is not None:
+        size += len(data)
+    if size % 512:
+        raise ChecksumError(f"Truncated tar archive ({size} bytes)")
+
+
+def _find_archives(paths: list[str]) -> list[str]:
+    archives = []
+    for path in paths:
+        if os.path.isdir(path):
+            archives += sorted(
+                os.path.join(path, f)
+                for f in os.listdir(path)
+                if f.endswith(ARCHIVE_SUFFIXES) and os.path.isfile(os.path.join(path, f))
+            )
+        else:
+            archives.append(path)
+    return archives
+
+
+if __name__ == "__main__":
+    sys.exit(main())
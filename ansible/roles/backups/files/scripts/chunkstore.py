@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""Content addressed, deduplicating chunk store for backup streams
+
+Streams are split into content defined chunks, each unique chunk is stored once
+(compressed) under its sha256 and every stored backup gets a manifest listing its chunks.
+
+A chunk boundary can fall after any byte: it is cut where the crc32 of the preceding
+WINDOW_SIZE bytes has its low bits all zero, so boundaries move with the data when bytes are
+inserted or removed ahead of them. Only positions after a run of bytes from a small set of
+candidate values are hashed, found at C speed with bytes.translate()/find(), rather than
+rolling a hash over every byte in python.
+"""
+
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+import zlib
+from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import IO, Iterator
+
+_truthy_strs = ["true", "1", "y", "yes"]
+DEBUG = os.getenv("DEBUG", "").lower() in _truthy_strs
+
+WINDOW_SIZE = 64
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+# 1 in 16 byte values are candidates, cut after a run of 3 candidate bytes when the low bits
+# of the window crc are all zero: 1 in 16**3 * 256 positions of random data, ~1MiB chunks
+CANDIDATE_TABLE = bytes(1 if value % 16 == 7 else 0 for value in range(256))
+CANDIDATE_RUN = b"\x01" * 3
+BOUNDARY_MASK = 256 - 1
+SCAN_SIZE = 256 * 1024
+READ_SIZE = 8 * 1024 * 1024
+MANIFEST_HEADER = "# chunkstore manifest v1"
+# Chunks written (or reused) more recently than this are never garbage collected, as they
+# may belong to a backup that is still being stored
+GC_GRACE_SECONDS = 24 * 60 * 60
+
+
+def main():
+    p = ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--store", required=True, help="Chunk store directory")
+    p.add_argument("-f", "--log-file", help="Output Log file")
+    sub = p.add_subparsers(dest="command", required=True)
+    store_p = sub.add_parser("store", help="Store stdin as a backup")
+    store_p.add_argument("name", help="Backup name")
+    store_p.add_argument("--level", type=int, default=3, help="zlib level (Default: %(default)s)")
+    restore_p = sub.add_parser("restore", help="Write a stored backup to stdout")
+    restore_p.add_argument("name", help="Backup name")
+    delete_p = sub.add_parser("delete", help="Delete a backup manifest (run gc to free space)")
+    delete_p.add_argument("name", help="Backup name")
+    sub.add_parser("list", help="List stored backups")
+    sub.add_parser("gc", help="Remove chunks no longer referenced by any backup")
+    opts = p.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if DEBUG else logging.INFO,
+        format="[%(asctime)s] [%(levelname)8s] [%(funcName)12.12s()] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        filename=opts.log_file,
+    )
+    try:
+        if opts.command == "store":
+            ChunkStore(opts.store, opts.level).store(opts.name, sys.stdin.buffer)
+        elif opts.command == "restore":
+            ChunkStore(opts.store).restore(opts.name, sys.stdout.buffer)
+        elif opts.command == "delete":
+            ChunkStore(opts.store).delete(opts.name)
+        elif opts.command == "list":
+            for name in ChunkStore(opts.store).list_backups():
+                print(name)
+        elif opts.command == "gc":
+            ChunkStore(opts.store).gc()
+    except ChunkStoreError as e:
+        logging.error(str(e))
+        return 1
+    return 0
+
+
+class ChunkStoreError(RuntimeError):
+    """Chunk Store Failure"""
+
+
+@dataclass
+class StoreStats:
+    chunks: int = 0
+    new_chunks: int = 0
+    bytes: int = 0
+    new_bytes: int = 0
+    stored_bytes: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.chunks} chunks ({self.bytes} bytes), {self.new_chunks} new "
+            f"({self.new_bytes} bytes, {self.stored_bytes} compressed)"
+        )
+
+
+class ChunkStore:
+    """Directory based store: chunks/<xx>/<sha256> and manifests/<name>"""
+
+    def __init__(self, path: str, level: int = 3, workers: int | None = None) -> None:
+        self.path = path
+        self.level = level
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_dir = os.path.join(path, "chunks")
+        self.manifest_dir = os.path.join(path, "manifests")
+
+    def store(self, name: str, stream: IO[bytes]) -> StoreStats:
+        """Chunk, deduplicate and store a stream of any size, then write its manifest
+
+        Compression and writing of new chunks runs in a bounded thread pool (zlib releases
+        the GIL) while the stream is read and chunked. Only chunks still being written are
+        tracked, so memory use does not grow with the size of the stream
+        """
+        manifest_path = self._manifest_path(name)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        stats = StoreStats()
+        stats_lock = threading.Lock()
+        in_flight = threading.BoundedSemaphore(self.workers * 2)
+        pending: set[str] = set()
+        chunk_dirs: set[str] = set()
+        tmp_manifest = f"{manifest_path}.partial"
+
+        def write_chunk(digest: str, chunk: bytes):
+            try:
+                stored = self._write_chunk(digest, chunk)
+                with stats_lock:
+                    stats.stored_bytes += stored
+                    chunk_dirs.add(os.path.dirname(self._chunk_path(digest)))
+            finally:
+                in_flight.release()
+
+        try:
+            with open(tmp_manifest, "w") as manifest, ThreadPoolExecutor(self.workers) as pool:
+                manifest.write(MANIFEST_HEADER + "\n")
+                # In flight chunk writes, by digest until written
+                futures: dict[Future, str] = {}
+                for chunk in iter_chunks(stream):
+                    digest = hashlib.sha256(chunk).hexdigest()
+                    manifest.write(f"{digest} {len(chunk)}\n")
+                    stats.chunks += 1
+                    stats.bytes += len(chunk)
+                    if digest in pending or self._touch_chunk(digest):
+                        continue
+                    pending.add(digest)
+                    stats.new_chunks += 1
+                    stats.new_bytes += len(chunk)
+                    in_flight.acquire()
+                    futures[pool.submit(write_chunk, digest, chunk)] = digest
+                    for future in [future for future in futures if future.done()]:
+                        future.result()
+                        pending.discard(futures.pop(future))
+                for future in futures:
+                    # Raise any chunk write failure before the manifest is committed
+                    future.result()
+                # New chunks (and their directory entries) must be durable before the
+                # manifest referencing them is
+                for chunk_dir in sorted(chunk_dirs):
+                    _fsync_dir(chunk_dir)
+                if chunk_dirs:
+                    _fsync_dir(self.chunk_dir)
+                manifest.flush()
+                os.fsync(manifest.fileno())
+            os.replace(tmp_manifest, manifest_path)
+            _fsync_dir(self.manifest_dir)
+        except BaseException:
+            if os.path.exists(tmp_manifest):
+                os.remove(tmp_manifest)
+            raise
+        logging.info(f"Stored backup {name}: {stats}")
+        return stats
+
+    def restore(self, name: str, out: IO[bytes]) -> int:
+        """Write a stored backup to out, verifying every chunk, returns bytes written"""
+        written = 0
+        for digest, size in self._read_manifest(name):
+            chunk = self._read_chunk(digest)
+            if len(chunk) != size or hashlib.sha256(chunk).hexdigest() != digest:
+                raise ChunkStoreError(f"Chunk {digest} is corrupt, unable to restore {name}")
+            out.write(chunk)
+            written += size
+        out.flush()
+        logging.info(f"Restored backup {name}: {written} bytes")
+        return written
+
+    def delete(self, name: str):
+        logging.info(f"Deleting backup {name}")
+        try:
+            os.remove(self._manifest_path(name))
+        except FileNotFoundError:
+            raise ChunkStoreError(f"No backup named {name}")
+
+    def list_backups(self) -> list[str]:
+        if not os.path.isdir(self.manifest_dir):
+            return []
+        return sorted(f for f in os.listdir(self.manifest_dir) if not f.endswith(".partial"))
+
+    def gc(self, grace_seconds: int = GC_GRACE_SECONDS) -> tuple[int, int]:
+        """Remove chunks not referenced by any manifest, returns (chunks, bytes) freed"""
+        referenced = set()
+        for name in self.list_backups():
+            referenced.update(digest for digest, _ in self._read_manifest(name))
+        cutoff = time.time() - grace_seconds
+        removed, freed = 0, 0
+        for dir_path, _, file_names in os.walk(self.chunk_dir):
+            for digest in file_names:
+                path = os.path.join(dir_path, digest)
+                stat = os.stat(path)
+                if digest in referenced or stat.st_mtime > cutoff:
+                    continue
+                logging.debug(f"Removing unreferenced chunk {digest}")
+                os.remove(path)
+                removed += 1
+                freed += stat.st_size
+        logging.info(f"Garbage collection removed {removed} chunks, {freed} bytes")
+        return removed, freed
+
+    def _manifest_path(self, name: str) -> str:
+        if not name or "/" in name or name.startswith("."):
+            raise ChunkStoreError(f"Invalid backup name: {name}")
+        return os.path.join(self.manifest_dir, name)
+
+    def _chunk_path(self, digest: str) -> str:
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def _touch_chunk(self, digest: str) -> bool:
+        """Mark an existing chunk as in use (for gc), returns False if it is not stored"""
+        try:
+            os.utime(self._chunk_path(digest))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _write_chunk(self, digest: str, chunk: bytes) -> int:
+        path = self._chunk_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = zlib.compress(chunk, self.level)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return len(data)
+
+    def _read_chunk(self, digest: str) -> bytes:
+        try:
+            with open(self._chunk_path(digest), "rb") as f:
+                return zlib.decompress(f.read())
+        except (OSError, zlib.error) as e:
+            raise ChunkStoreError(f"Unable to read chunk {digest}: {e}")
+
+    def _read_manifest(self, name: str) -> Iterator[tuple[str, int]]:
+        try:
+            with open(self._manifest_path(name), "r") as f:
+                if f.readline().strip() != MANIFEST_HEADER:
+                    raise ChunkStoreError(f"Invalid manifest for backup {name}")
+                for line in f:
+                    digest, size = line.split()
+                    yield digest, int(size)
+        except FileNotFoundError:
+            raise ChunkStoreError(f"No backup named {name}")
+
+
+def _fsync_dir(path: str):
+    """Flush a directory's entries (created or renamed files) to disk"""
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def iter_chunks(stream: IO[bytes]) -> Iterator[bytes]:
+    """Split a stream into content defined chunks, holding at most a few MB in memory"""
+    buf = bytearray()
+    while data := stream.read(READ_SIZE):
+        buf += data
+        start = 0
+        while (cut := _find_boundary(buf, start)) is not None:
+            yield bytes(buf[start:cut])
+            start = cut
+        del buf[:start]
+    if buf:
+        yield bytes(buf)
+
+
+def _find_boundary(buf: bytearray, start: int) -> int | None:
+    """Get the end of the chunk starting at start, None if more data is needed to decide"""
+    limit = min(start + MAX_CHUNK_SIZE, len(buf))
+    # Scanned a piece at a time, most chunks end long before MAX_CHUNK_SIZE
+    for first in range(start + MIN_CHUNK_SIZE, limit + 1, SCAN_SIZE):
+        # candidates[i] is set if the byte at first - len(CANDIDATE_RUN) + i is a candidate
+        piece = buf[first - len(CANDIDATE_RUN) : min(first + SCAN_SIZE - 1, limit)]
+        candidates = piece.translate(CANDIDATE_TABLE)
+        i = candidates.find(CANDIDATE_RUN)
+        while i != -1:
+            pos = first + i
+            if zlib.crc32(buf[pos - WINDOW_SIZE : pos]) & BOUNDARY_MASK == 0:
+                return pos
+            i = candidates.find(CANDIDATE_RUN, i + 1)
+    if start + MAX_CHUNK_SIZE <= len(buf):
+        return start + MAX_CHUNK_SIZE
+    return None
+
+
+if __name__ == "__main__":
+    sys.exit(main())
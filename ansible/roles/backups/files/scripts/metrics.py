@@ -0,0 +1,126 @@
+"""Backup run metrics in InfluxDB line protocol, for telegraf to pick up
+
+Metrics are buffered for the run and written in one go by flush() to METRICS_TARGET, which
+is either a file to append to, or a telegraf socket_listener address: unix://<path>,
+unixgram://<path> or udp://<host>:<port>. Without METRICS_TARGET nothing is written.
+Failing to write metrics is logged but never fails a backup.
+"""
+
+import fcntl
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+METRICS_TARGET = os.getenv("METRICS_TARGET")
+
+
+class Metrics:
+    """Collects measurements for a run, every point is tagged with the script name and any
+    tags set on the instance (e.g. the backup target)
+    """
+
+    def __init__(self, script: str, output: str | None = METRICS_TARGET) -> None:
+        self.output = output
+        self.tags: dict[str, str] = {"script": script}
+        self._lines: list[str] = []
+        self._lock = threading.Lock()
+
+    def add(self, measurement: str, fields: dict[str, Any], **tags: str):
+        """Add a point, fields with a None value are left out"""
+        fields = {key: value for key, value in fields.items() if value is not None}
+        if not fields:
+            return
+        line = format_line(measurement, {**self.tags, **tags}, fields, time.time_ns())
+        with self._lock:
+            self._lines.append(line)
+
+    @contextmanager
+    def phase(self, name: str, **tags: str) -> Iterator[dict[str, Any]]:
+        """Time a phase of the run as a backup_phase point
+
+        Yields a dict that extra fields (e.g. bytes) can be added to, ok is set to False if
+        the phase raises
+        """
+        fields: dict[str, Any] = {}
+        start = time.monotonic()
+        try:
+            yield fields
+            fields["ok"] = True
+        except BaseException:
+            fields["ok"] = False
+            raise
+        finally:
+            fields["duration_s"] = time.monotonic() - start
+            self.add("backup_phase", fields, phase=name, **tags)
+
+    def flush(self):
+        """Write out all points collected so far"""
+        with self._lock:
+            lines, self._lines = self._lines, []
+        if not self.output or not lines:
+            return
+        payload = "".join(line + "\n" for line in lines).encode()
+        try:
+            _write_payload(self.output, payload)
+        except OSError as e:
+            logging.warning(f"Unable to write metrics to {self.output}: {e}")
+            return
+        logging.debug(f"Wrote {len(lines)} metrics to {self.output}")
+
+
+def format_line(
+    measurement: str, tags: dict[str, str], fields: dict[str, Any], timestamp_ns: int
+) -> str:
+    """Format a single point in InfluxDB line protocol"""
+    tag_str = "".join(
+        f",{_escape_key(key)}={_escape_key(str(value))}"
+        for key, value in sorted(tags.items())
+        if value not in (None, "")
+    )
+    field_str = ",".join(
+        f"{_escape_key(key)}={_format_field(value)}" for key, value in fields.items()
+    )
+    measurement = measurement.replace(",", "\\,").replace(" ", "\\ ")
+    return f"{measurement}{tag_str} {field_str} {timestamp_ns}"
+
+
+def _escape_key(value: str) -> str:
+    return value.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def _format_field(value: Any) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _write_payload(output: str, payload: bytes):
+    scheme, _, address = output.partition("://")
+    if not address:
+        # Plain file path, locked as several backup scripts may append at once
+        with open(output, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(payload)
+        return
+    if scheme == "unix":
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(5)
+            sock.connect(address)
+            sock.sendall(payload)
+    elif scheme == "unixgram":
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(payload, address)
+    elif scheme == "udp":
+        host, _, port = address.rpartition(":")
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(payload, (host, int(port)))
+    else:
+        raise OSError(f"Unsupported metrics target scheme: {scheme}")
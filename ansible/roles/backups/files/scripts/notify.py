@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Spooled webhook notifications for the backup scripts
+
+Events are queued as files in a local spool, so queueing never blocks on (or loses an alert
+to) a slow or unavailable webhook. flush() sends everything in the spool, from any script,
+batched into as few messages as possible, with timeouts, retries with backoff and rate limit
+handling, within a time budget. Anything not sent stays in the spool for the next run.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import time
+from argparse import ArgumentParser
+from dataclasses import asdict, dataclass
+from datetime import datetime
+
+import requests
+from runjournal import STATE_DIR
+
+_truthy_strs = ["true", "1", "y", "yes"]
+DEBUG = os.getenv("DEBUG", "").lower() in _truthy_strs
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Queue a summary of successful runs as well as failures
+NOTIFY_SUCCESS = os.getenv("NOTIFY_SUCCESS", "").lower() in _truthy_strs
+SPOOL_DIR = os.getenv("NOTIFY_SPOOL_DIR", os.path.join(STATE_DIR, "notify"))
+# Wait before sending, so events from backup jobs finishing around the same time are merged
+BATCH_WAIT = float(os.getenv("NOTIFY_BATCH_WAIT", "2"))
+# Total time flush() may take, including retries
+FLUSH_BUDGET = float(os.getenv("NOTIFY_FLUSH_BUDGET", "30"))
+REQUEST_TIMEOUT = (5, 10)
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 1.0
+# Events that could not be sent for this long are dropped
+MAX_EVENT_AGE = 7 * 24 * 3600
+# Discord rejects message content longer than this
+MAX_MESSAGE_LENGTH = 2000
+# Message title of each notification level, in the order they are sent
+LEVEL_TITLES = {"error": "Backup Error:", "info": "Backup Summary:"}
+# Title for spooled events of any other level (e.g. from an older version)
+DEFAULT_TITLE = "Backup Notification:"
+
+
+class NotificationRejected(RuntimeError):
+    """The webhook rejected a notification (4xx other than rate limiting)"""
+
+
+@dataclass
+class Event:
+    """A queued notification"""
+
+    level: str
+    message: str
+    source: str
+    created: float
+
+    @property
+    def line(self) -> str:
+        created = datetime.fromtimestamp(self.created).strftime("%Y-%m-%d %H:%M:%S")
+        return f"[{created}] {self.source}: {self.message}"
+
+
+class Notifier:
+    """Queue notifications to the spool and send them to the webhook"""
+
+    def __init__(
+        self, source: str, url: str | None = WEBHOOK_URL, spool_dir: str = SPOOL_DIR
+    ) -> None:
+        self.source = source
+        self.url = url
+        self.spool_dir = spool_dir
+
+    def error(self, message: str):
+        self.queue("error", message)
+
+    def success(self, message: str):
+        """Queue a success summary, only if NOTIFY_SUCCESS is set"""
+        if NOTIFY_SUCCESS:
+            self.queue("info", message)
+
+    def queue(self, level: str, message: str):
+        if level not in LEVEL_TITLES:
+            raise ValueError(f"Unknown notification level: {level}")
+        if self.url is None:
+            logging.info("Webhook not set - skipping notification")
+            return
+        event = Event(level, str(message), self.source, time.time())
+        os.makedirs(self.spool_dir, exist_ok=True)
+        name = f"{time.time_ns()}-{os.getpid()}-{random.getrandbits(32):08x}.json"
+        tmp_path = os.path.join(self.spool_dir, f".{name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(asdict(event), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.spool_dir, name))
+        logging.debug(f"Queued {level} notification {name}")
+
+    def flush(self, budget: float = FLUSH_BUDGET, batch_wait: float = BATCH_WAIT) -> bool:
+        """Send all spooled events, returns True if the spool was emptied
+
+        Only one process flushes at a time, if another already is it will pick up our
+        events too, so there is nothing to wait for
+        """
+        if self.url is None or not os.path.isdir(self.spool_dir):
+            return True
+        deadline = time.monotonic() + budget
+        with open(os.path.join(self.spool_dir, ".lock"), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info("Notifications are being sent by another run")
+                return False
+            if batch_wait and self._spooled():
+                time.sleep(min(batch_wait, budget))
+            # Keep going until the spool is empty, jobs may queue more while we send
+            while spooled := self._spooled():
+                events = self._load(spooled)
+                for message, paths in _batch(events):
+                    try:
+                        sent = self._post(message, deadline)
+                    except NotificationRejected as e:
+                        # Sending it again will never succeed, so drop it rather than retry
+                        # it every run until it expires
+                        logging.error(f"Dropping rejected notifications ({e}): {message}")
+                        sent = True
+                    if not sent:
+                        logging.warning(
+                            f"{len(self._spooled())} notifications left in spool for next run"
+                        )
+                        return False
+                    for path in paths:
+                        os.remove(path)
+        return True
+
+    def _spooled(self) -> list[str]:
+        return sorted(
+            os.path.join(self.spool_dir, f)
+            for f in os.listdir(self.spool_dir)
+            if f.endswith(".json") and not f.startswith(".")
+        )
+
+    def _load(self, paths: list[str]) -> list[tuple[str, Event]]:
+        events = []
+        for path in paths:
+            try:
+                with open(path, "r") as f:
+                    event = Event(**json.load(f))
+            except (ValueError, TypeError) as e:
+                logging.warning(f"Dropping unreadable notification {path}: {e}")
+                os.remove(path)
+                continue
+            if time.time() - event.created > MAX_EVENT_AGE:
+                logging.warning(f"Dropping expired notification: {event.line}")
+                os.remove(path)
+                continue
+            events.append((path, event))
+        return events
+
+    def _post(self, message: str, deadline: float) -> bool:
+        """Post a message, retrying until sent or out of attempts or time
+
+        Raises NotificationRejected for a request the webhook will never accept
+        """
+        payload = {"username": platform.node(), "content": message}
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.warning("Notification time budget used up")
+                return False
+            timeout = (min(REQUEST_TIMEOUT[0], remaining), min(REQUEST_TIMEOUT[1], remaining))
+            retry_after = BACKOFF_BASE * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            try:
+                res = requests.post(self.url, json=payload, timeout=timeout)
+            except requests.RequestException as e:
+                logging.warning(f"Notification attempt {attempt} failed: {e}")
+            else:
+                if res.ok:
+                    logging.info("Sent notification")
+                    return True
+                if res.status_code == 429:
+                    retry_after = _retry_after(res, retry_after)
+                    logging.warning(f"Notification rate limited, retrying in {retry_after:.1f}s")
+                elif res.status_code < 500:
+                    # Not going to succeed by retrying (bad URL or payload)
+                    raise NotificationRejected(f"{res.status_code} {res.text[:200]}")
+                else:
+                    logging.warning(f"Notification attempt {attempt} failed: {res.status_code}")
+            if attempt == MAX_ATTEMPTS:
+                break
+            if time.monotonic() + retry_after > deadline:
+                logging.warning("Not enough of the notification time budget left to retry")
+                return False
+            time.sleep(retry_after)
+        return False
+
+
+def _retry_after(res: requests.Response, default: float) -> float:
+    """Seconds to wait from a 429 response, Discord sends retry_after in the body"""
+    try:
+        return float(res.json()["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        pass
+    try:
+        return float(res.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return default
+
+
+def _batch(events: list[tuple[str, Event]]) -> list[tuple[str, list[str]]]:
+    """Merge events into messages (errors first) no longer than MAX_MESSAGE_LENGTH
+
+    Returns (message, spool paths of the events in it)
+    """
+    batches: list[tuple[str, list[str]]] = []
+    other_levels = sorted({event.level for _, event in events} - LEVEL_TITLES.keys())
+    for level in [*LEVEL_TITLES, *other_levels]:
+        title = LEVEL_TITLES.get(level, DEFAULT_TITLE)
+        message, paths = title, []
+        for path, event in events:
+            if event.level != level:
+                continue
+            line = event.line[: MAX_MESSAGE_LENGTH - len(title) - 1]
+            if paths and len(message) + 1 + len(line) > MAX_MESSAGE_LENGTH:
+                batches.append((message, paths))
+                message, paths = title, []
+            message += f"\n{line}"
+            paths.append(path)
+        if paths:
+            batches.append((message, paths))
+    return batches
+
+
+def main():
+    p = ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("-f", "--log-file", help="Output Log file")
+    sub = p.add_subparsers(dest="command", required=True)
+    send_p = sub.add_parser("send", help="Queue a notification and flush the spool")
+    send_p.add_argument("message", help="Message to send")
+    send_p.add_argument("--info", action="store_true", help="Send as a summary, not an error")
+    sub.add_parser("flush", help="Send any spooled notifications")
+    sub.add_parser("list", help="List spooled notifications")
+    opts = p.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG if DEBUG else logging.INFO,
+        format="[%(asctime)s] [%(levelname)8s] [%(funcName)12.12s()] %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+        filename=opts.log_file,
+    )
+    notifier = Notifier("notify")
+    if opts.command == "list":
+        if os.path.isdir(notifier.spool_dir):
+            for _, event in notifier._load(notifier._spooled()):
+                print(f"{event.level:5} {event.line}")
+        return 0
+    if opts.command == "send":
+        notifier.queue("info" if opts.info else "error", opts.message)
+    return 0 if notifier.flush() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
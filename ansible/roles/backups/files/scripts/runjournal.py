@@ -0,0 +1,147 @@
+"""Per dataset run locking and per target step journal for the backup scripts
+
+Each dataset or LV a backup touches gets an exclusive lock, so overlapping runs (a slow run
+and the next cron tick, or two targets sharing a source) skip the target rather than
+interfere with each other. Each target (source -> destination) gets a journal of the steps
+completed so far, so a run after a crash can resume or roll back cleanly. Targets on
+different datasets use separate locks and can still be backed up in parallel.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import datetime
+from typing import Any
+
+_truthy_strs = ["true", "1", "y", "yes"]
+DRY_RUN = os.getenv("DRY_RUN", "").lower() in _truthy_strs
+STATE_DIR = os.getenv("BACKUP_STATE_DIR", "/var/lib/backup_scripts")
+
+
+class RunLockedError(RuntimeError):
+    """Another run holds the lock for the target"""
+
+
+class RunJournal:
+    """Lock and journal for one backup target, use as a context manager for the whole run
+
+    Steps are recorded (and synced to disk) as they complete, a finished run calls
+    complete() to clear the journal. Any steps present on entry are from an interrupted run
+    """
+
+    key: str
+    steps: dict[str, Any]
+
+    def __init__(
+        self, target: str, state_dir: str | None = None, locks: list[str] | None = None
+    ) -> None:
+        """locks names the datasets/LVs the run touches (Default: the target)"""
+        self.target = target
+        self.state_dir = state_dir or STATE_DIR
+        self.key = _state_key(target)
+        self.journal_path = os.path.join(self.state_dir, f"{self.key}.journal")
+        # Sorted, so runs sharing datasets always try to take their locks in the same order
+        self.locks = sorted(set(locks or [target]))
+        self.steps = {}
+        self._lock_files = []
+
+    def __enter__(self) -> "RunJournal":
+        if not DRY_RUN:
+            os.makedirs(self.state_dir, exist_ok=True)
+            for name in self.locks:
+                lock_file = open(os.path.join(self.state_dir, f"{_state_key(name)}.lock"), "a")
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    self.__exit__()
+                    raise RunLockedError(f"Another backup run is in progress for {name}")
+                self._lock_files.append(lock_file)
+            self._migrate_legacy_journal()
+        self.steps = self._load()
+        if self.steps:
+            logging.warning(
+                f"Found journal of an interrupted run for {self.target}, "
+                f"completed steps: {', '.join(self.steps)}"
+            )
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        for lock_file in reversed(self._lock_files):
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        self._lock_files = []
+
+    def __contains__(self, step: str) -> bool:
+        return step in self.steps
+
+    @property
+    def interrupted(self) -> bool:
+        """Whether the journal holds steps of a previous run that did not complete"""
+        return bool(self.steps)
+
+    def get(self, step: str, default: Any = None) -> Any:
+        return self.steps.get(step, default)
+
+    def record(self, step: str, value: Any = True):
+        """Record a completed step (with an optional value, e.g. the snapshot name)"""
+        logging.debug(f"Journal {self.key}: {step}={value}")
+        self.steps[step] = value
+        self._save()
+
+    def complete(self):
+        """Clear the journal once the run has finished all of its steps"""
+        self.steps = {}
+        if not DRY_RUN and os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def _load(self) -> dict[str, Any]:
+        try:
+            with open(self.journal_path, "r") as f:
+                return json.load(f)["steps"]
+        except FileNotFoundError:
+            return {}
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable journal {self.journal_path}: {e}")
+            return {}
+
+    def _migrate_legacy_journal(self):
+        """Pick up the journal of an interrupted run from before keys were hashed
+
+        Legacy keys could be shared by several targets, so only a journal written for this
+        exact target is taken
+        """
+        legacy_key = re.sub(r"[^A-Za-z0-9_.]+", "_", self.target).strip("_")
+        legacy_path = os.path.join(self.state_dir, f"{legacy_key}.journal")
+        if os.path.exists(self.journal_path) or not os.path.exists(legacy_path):
+            return
+        try:
+            with open(legacy_path, "r") as f:
+                if json.load(f).get("target") != self.target:
+                    return
+        except ValueError:
+            return
+        logging.info(f"Moving journal {legacy_path} to {self.journal_path}")
+        os.replace(legacy_path, self.journal_path)
+
+    def _save(self):
+        if DRY_RUN:
+            return
+        tmp_path = f"{self.journal_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"target": self.target, "updated": datetime.now().isoformat(), "steps": self.steps},
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+
+def _state_key(name: str) -> str:
+    """File name safe key for a target or lock name, readable and unique to the name"""
+    readable = re.sub(r"[^A-Za-z0-9_.]+", "_", name).strip("_")[:64]
+    return f"{readable}-{hashlib.sha256(name.encode()).hexdigest()[:16]}"
@@ -0,0 +1,190 @@
+"""Dataset and snapshot size time series, for capacity forecasting
+
+Samples are appended to a columnar index: one file of fixed width values per column, with
+dataset and snapshot names stored once in dictionary files and referenced by id. Appends
+only ever add to the end of each file, a partly written append (columns of unequal length)
+is ignored on read and trimmed by the next append.
+"""
+
+import fcntl
+import os
+from array import array
+from dataclasses import dataclass
+
+# Column name -> array type code, all sizes are bytes and times are epoch seconds
+COLUMNS = {
+    "time": "q",
+    "dataset": "I",
+    "snapshot": "I",
+    "creation": "q",
+    "used": "q",
+    "referenced": "q",
+    "written": "q",
+    "available": "q",
+}
+DATASETS_FILE = "datasets.txt"
+# Snapshot id 0 marks a dataset sample, snapshot ids start at 1
+SNAPSHOTS_FILE = "snapshots.txt"
+SECONDS_PER_DAY = 24 * 3600
+
+
+@dataclass
+class SizeSample:
+    """Sizes of a dataset (snapshot is None) or one of its snapshots, -1 where unknown"""
+
+    time: int
+    dataset: str
+    snapshot: str | None
+    creation: int
+    used: int
+    referenced: int
+    written: int
+    available: int = -1
+
+
+class SizeIndex:
+    """Append-only columnar store of SizeSamples"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.columns: dict[str, array] = {}
+        self.datasets: list[str] = []
+        self.snapshots: list[str] = []
+
+    def append(self, samples: list[SizeSample]):
+        """Append samples, safe against other processes appending at the same time"""
+        if not samples:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, ".lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._trim_columns()
+            dataset_ids = self._intern(DATASETS_FILE, [s.dataset for s in samples], start=0)
+            snapshot_ids = self._intern(
+                SNAPSHOTS_FILE, [s.snapshot for s in samples if s.snapshot], start=1
+            )
+            for column, type_code in COLUMNS.items():
+                if column == "dataset":
+                    values = array(type_code, (dataset_ids[s.dataset] for s in samples))
+                elif column == "snapshot":
+                    values = array(
+                        type_code, (snapshot_ids[s.snapshot] if s.snapshot else 0 for s in samples)
+                    )
+                else:
+                    values = array(type_code, (getattr(s, column) for s in samples))
+                with open(self._column_path(column), "ab") as f:
+                    values.tofile(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+        self.columns = {}
+
+    def load(self) -> "SizeIndex":
+        """Read the whole index into memory for queries"""
+        columns = {column: self._read_column(column) for column in COLUMNS}
+        rows = min(len(values) for values in columns.values())
+        self.columns = {column: values[:rows] for column, values in columns.items()}
+        self.datasets = self._read_names(DATASETS_FILE)
+        self.snapshots = self._read_names(SNAPSHOTS_FILE)
+        return self
+
+    def dataset_series(self, dataset: str) -> list[tuple[int, int, int]]:
+        """(time, used, available) samples of a dataset, oldest first"""
+        if dataset not in self.datasets:
+            return []
+        dataset_id = self.datasets.index(dataset)
+        cols = self.columns
+        return sorted(
+            (cols["time"][i], cols["used"][i], cols["available"][i])
+            for i in range(len(cols["time"]))
+            if cols["dataset"][i] == dataset_id and cols["snapshot"][i] == 0
+        )
+
+    def latest_snapshots(self, dataset: str) -> list[SizeSample]:
+        """Snapshots of a dataset as of its most recent sample, oldest first"""
+        if dataset not in self.datasets:
+            return []
+        dataset_id = self.datasets.index(dataset)
+        cols = self.columns
+        rows = [i for i in range(len(cols["time"])) if cols["dataset"][i] == dataset_id]
+        if not rows:
+            return []
+        latest = max(cols["time"][i] for i in rows)
+        samples = [
+            SizeSample(
+                time=latest,
+                dataset=dataset,
+                snapshot=self.snapshots[cols["snapshot"][i] - 1],
+                **{c: cols[c][i] for c in ("creation", "used", "referenced", "written")},
+            )
+            for i in rows
+            if cols["time"][i] == latest and cols["snapshot"][i]
+        ]
+        return sorted(samples, key=lambda s: s.creation)
+
+    def growth_rate(self, dataset: str, since: int = 0) -> float | None:
+        """Growth of the dataset used space in bytes/day, a least squares fit over the samples
+        taken since the given time, None without at least two samples
+        """
+        series = [(t, used) for t, used, _ in self.dataset_series(dataset) if t >= since]
+        if len({t for t, _ in series}) < 2:
+            return None
+        mean_t = sum(t for t, _ in series) / len(series)
+        mean_used = sum(used for _, used in series) / len(series)
+        covariance = sum((t - mean_t) * (used - mean_used) for t, used in series)
+        variance = sum((t - mean_t) ** 2 for t, _ in series)
+        return covariance / variance * SECONDS_PER_DAY
+
+    def days_to_full(self, dataset: str, since: int = 0) -> float | None:
+        """Days until the available space runs out at the current growth rate, None if it is
+        not growing or there is not enough data
+        """
+        series = self.dataset_series(dataset)
+        rate = self.growth_rate(dataset, since)
+        if not series or not rate or rate <= 0 or series[-1][2] < 0:
+            return None
+        return series[-1][2] / rate
+
+    def _column_path(self, column: str) -> str:
+        return os.path.join(self.path, f"{column}.{COLUMNS[column]}")
+
+    def _read_column(self, column: str) -> array:
+        values = array(COLUMNS[column])
+        try:
+            with open(self._column_path(column), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return values
+        values.frombytes(data[: len(data) - len(data) % values.itemsize])
+        return values
+
+    def _trim_columns(self):
+        """Cut every column back to the rows fully written by previous appends"""
+        sizes = {}
+        for column in COLUMNS:
+            path = self._column_path(column)
+            sizes[column] = os.path.getsize(path) if os.path.exists(path) else 0
+        rows = min(size // array(COLUMNS[column]).itemsize for column, size in sizes.items())
+        for column, size in sizes.items():
+            if size != rows * array(COLUMNS[column]).itemsize:
+                with open(self._column_path(column), "ab") as f:
+                    f.truncate(rows * array(COLUMNS[column]).itemsize)
+
+    def _read_names(self, file_name: str) -> list[str]:
+        try:
+            with open(os.path.join(self.path, file_name), "r") as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def _intern(self, file_name: str, names: list[str], start: int) -> dict[str, int]:
+        """Ids of names in a dictionary file, adding any new names to it"""
+        known = self._read_names(file_name)
+        ids = {name: i + start for i, name in enumerate(known)}
+        new_names = [name for name in dict.fromkeys(names) if name not in ids]
+        if new_names:
+            with open(os.path.join(self.path, file_name), "a") as f:
+                f.write("".join(f"{name}\n" for name in new_names))
+                f.flush()
+                os.fsync(f.fileno())
+            ids.update({name: len(known) + i + start for i, name in enumerate(new_names)})
+        return ids
@@ -0,0 +1,205 @@
+"""Bandwidth and process priority throttling for the backup scripts
+
+A token bucket caps the rate backup streams are moved at, so a full send or archive does not
+saturate the disks and network shared with services on the same host. The cap can change
+by time of day, e.g. a tight cap during working hours and none overnight. The nice value
+and I/O scheduling class are set on the script itself, so all child processes (zfs send,
+tar, compressors) inherit them.
+"""
+
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import IO
+
+RATE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+RATE_RE = re.compile(r"^(?P<value>\d+(\.\d+)?)(?P<unit>[KMG]?)$", re.IGNORECASE)
+WINDOW_RE = re.compile(r"^(?P<start>\d{1,2}:\d{2})-(?P<end>\d{1,2}:\d{2})=(?P<rate>.+)$")
+IO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+# The bucket holds at most this much of a second's worth of bytes, so bursts stay short
+BURST_SECONDS = 0.1
+MIN_CHUNK_SIZE = 64 * 1024
+# How often the schedule is checked for a new rate during a transfer
+SCHEDULE_CHECK_INTERVAL = 60
+
+
+def parse_rate(spec: str) -> int | None:
+    """Parse a rate like '512K' or '20M' (bytes/sec, binary units), 0 is no cap (None)"""
+    match = RATE_RE.match(spec.strip())
+    if not match:
+        raise ArgumentTypeError(f"Invalid rate '{spec}', expected e.g. 512K, 20M or 1G")
+    rate = int(float(match.group("value")) * RATE_UNITS[match.group("unit").upper()])
+    return rate or None
+
+
+def parse_schedule(spec: str) -> list[tuple[int, int, int | None]]:
+    """Parse time of day rate windows like '08:00-18:00=10M,18:00-23:00=50M'
+
+    Returns (start minute, end minute, rate) windows, a window may wrap past midnight
+    """
+    windows = []
+    for window in spec.split(","):
+        match = WINDOW_RE.match(window.strip())
+        if not match:
+            raise ArgumentTypeError(
+                f"Invalid schedule window '{window}', expected HH:MM-HH:MM=<rate>"
+            )
+        start, end = (_parse_time(match.group(name)) for name in ("start", "end"))
+        windows.append((start, end, parse_rate(match.group("rate"))))
+    return windows
+
+
+def _parse_time(value: str) -> int:
+    hours, minutes = (int(part) for part in value.split(":"))
+    if hours > 23 or minutes > 59:
+        raise ArgumentTypeError(f"Invalid time of day '{value}'")
+    return hours * 60 + minutes
+
+
+@dataclass
+class RateSchedule:
+    """Rate cap in bytes/sec (None for no cap), overridden by the first matching window"""
+
+    rate: int | None = None
+    windows: list[tuple[int, int, int | None]] = field(default_factory=list)
+
+    def rate_at(self, now: datetime) -> int | None:
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            in_window = start <= minute < end if start <= end else minute >= start or minute < end
+            if in_window:
+                return rate
+        return self.rate
+
+
+class Throttle:
+    """Token bucket shared by every stream of the process, safe to use from several threads"""
+
+    def __init__(self, schedule: RateSchedule | None = None) -> None:
+        self.schedule = schedule or RateSchedule()
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._rate: int | None = None
+        self._rate_checked: float | None = None
+
+    def set_schedule(self, schedule: RateSchedule):
+        self.schedule = schedule
+        self._rate_checked = None
+
+    @property
+    def rate(self) -> int | None:
+        """Current cap in bytes/sec from the schedule, None if not capped"""
+        now = time.monotonic()
+        if self._rate_checked is None or now - self._rate_checked >= SCHEDULE_CHECK_INTERVAL:
+            rate = self.schedule.rate_at(datetime.now())
+            if rate != self._rate and self._rate_checked is not None:
+                logging.info(f"Bandwidth cap changed to {f'{rate} bytes/sec' if rate else 'none'}")
+            self._rate, self._rate_checked = rate, now
+        return self._rate
+
+    def chunk_size(self, default: int) -> int:
+        """Size to move at a time, smaller than default when capped to keep bursts short"""
+        rate = self.rate
+        if rate is None:
+            return default
+        return min(default, max(int(rate * BURST_SECONDS), MIN_CHUNK_SIZE))
+
+    def consume(self, n: int):
+        """Take n bytes worth of tokens, sleeping for as long as the bucket is in debt"""
+        rate = self.rate
+        if rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            burst = max(rate * BURST_SECONDS, MIN_CHUNK_SIZE)
+            self._tokens = min(burst, self._tokens + (now - self._updated) * rate) - n
+            self._updated = now
+            wait = -self._tokens / rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def reader(self, stream: IO[bytes]) -> "_ThrottledReader":
+        """Wrap a stream so reading from it is throttled"""
+        return _ThrottledReader(stream, self)
+
+
+class _ThrottledReader:
+    def __init__(self, stream: IO[bytes], throttle: Throttle) -> None:
+        self.stream = stream
+        self.throttle = throttle
+
+    def read(self, size: int = -1) -> bytes:
+        chunk_size = self.throttle.chunk_size(size if size > 0 else MIN_CHUNK_SIZE * 16)
+        data = self.stream.read(chunk_size)
+        self.throttle.consume(len(data))
+        return data
+
+    def readinto(self, buf) -> int:
+        view = memoryview(buf)
+        n = self.stream.readinto(view[: self.throttle.chunk_size(len(view))])
+        self.throttle.consume(n or 0)
+        return n
+
+    def close(self):
+        self.stream.close()
+
+
+def set_priority(io_class: str | None = None, io_level: int | None = None, nice: int = 0):
+    """Lower the CPU and I/O priority of this process, inherited by child processes"""
+    if nice:
+        os.nice(nice)
+    if io_class is None:
+        return
+    cmd = ["ionice", "-c", str(IO_CLASSES[io_class])]
+    if io_level is not None and io_class != "idle":
+        cmd += ["-n", str(io_level)]
+    try:
+        res = subprocess.run([*cmd, "-p", str(os.getpid())], capture_output=True)
+    except OSError as e:
+        logging.warning(f"Unable to set I/O priority: {e}")
+        return
+    if res.returncode != 0:
+        logging.warning(f"Unable to set I/O priority: {res.stderr.decode().strip()}")
+
+
+def add_throttle_arguments(parser: ArgumentParser):
+    """Add the throttling options, see apply_throttle_options"""
+    grp = parser.add_argument_group("throttling")
+    grp.add_argument(
+        "--bwlimit",
+        type=parse_rate,
+        help="Cap backup streams to this many bytes/sec, e.g. 512K or 20M, 0 for no cap",
+    )
+    grp.add_argument(
+        "--bwlimit-schedule",
+        type=parse_schedule,
+        default=[],
+        help="Time of day caps overriding --bwlimit, e.g. '08:00-18:00=10M,18:00-23:00=50M'",
+    )
+    grp.add_argument(
+        "--nice", type=int, default=0, help="Nice increment for the backup and child processes"
+    )
+    grp.add_argument(
+        "--io-class",
+        choices=IO_CLASSES,
+        help="I/O scheduling class for the backup and child processes, e.g. idle",
+    )
+    grp.add_argument(
+        "--io-level",
+        type=int,
+        choices=range(8),
+        help="I/O priority within the realtime and best-effort classes (0 is highest)",
+    )
+
+
+def apply_throttle_options(options: Namespace, throttle: Throttle):
+    """Set the process priority and throttle schedule from the add_throttle_arguments options"""
+    set_priority(options.io_class, options.io_level, options.nice)
+    throttle.set_schedule(RateSchedule(options.bwlimit, options.bwlimit_schedule))
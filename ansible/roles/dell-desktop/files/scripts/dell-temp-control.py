@@ -4,9 +4,13 @@
 Inspired by
 https://github.com/vitorafsr/i8kutils/issues/25#issuecomment-1097806307
 """
+import csv
+import fcntl
 import logging
 import os
 import re
+import select
+import struct
 import subprocess
 import sys
 from argparse import ArgumentParser
@@ -15,14 +19,45 @@ from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
 from statistics import mean
-from time import sleep
-from typing import Optional, Sequence
+from time import monotonic, process_time, sleep, time
+from typing import Optional, Protocol, Sequence, TextIO
 
-HWMON_BASE = "/sys/class/hwmon"
+# Overridable to point at a fake sysfs/procfs tree for testing
+HWMON_BASE = os.getenv("HWMON_BASE", "/sys/class/hwmon")
+I8K_PROC = os.getenv("I8K_PROC", "/proc/i8k")
 I8KFAN = "/usr/bin/i8kfan"
+# Fan backends in the order "auto" tries them
+FAN_BACKENDS = ["hwmon", "proc", "i8kfan"]
+DELL_SMM_MODULE = "dell_smm"
+# dell_smm_hwmon scales fan states 0..I8K_FAN_MAX to pwm values 0..PWM_MAX
+I8K_FAN_MAX = 2
+PWM_MAX = 255
+# /proc/i8k fields: version, bios, serial, cpu temp, left/right fan state, left/right speed...
+I8K_PROC_FAN_STATE_FIELD = 4
+# _IOWR('i', 0x87, size_t) from linux/i8k.h, takes int[2] of fan index and state
+I8K_SET_FAN = 0xC0086987
 UNSET_TEMP = -100
 TEMP_HIST = 5
 TEMP_WEIGHT_FACTOR = 5
+# Adaptive polling: temp change rates in milli-degrees C per second
+FAST_RISE_RATE = 1000
+STABLE_RATE = 100
+INTERVAL_BACKOFF = 1.5
+# Backing off only reaches max_interval with this much headroom (milli-degrees C) below the
+# next threshold up, closer to it the longest interval shrinks towards interval
+BACKOFF_HEADROOM = 10000
+# Sensor attributes that drivers may sysfs_notify on, so poll() can wake the loop early
+SENSOR_ALARMS = ["alarm", "max_alarm", "crit_alarm"]
+CONTROLLERS = ["threshold", "pid", "curve"]
+# PID integral gain defaults to the proportional gain over this many seconds
+PID_INTEGRAL_TIME = 60
+# Default --min-dwell of the pid and curve controllers, threshold mode has none by default
+MIN_DWELL = 20
+# Replay thermal model: ambient temp (milli-degrees C) and the fraction of the difference from
+# ambient removed per second at each fan state (OFF, LOW, HIGH)
+SIM_AMBIENT_TEMP = 30000
+SIM_COOLING_RATES = (0.01, 0.02, 0.04)
+TRACE_FIELDS = ["time", "temp", "fan_state", "requested"]
 DRY_RUN = False
 
 
@@ -30,13 +65,128 @@ DRY_RUN = False
 class TempSensor:
     label: str
     idx: str
-    max: int
+    max: Optional[int]
     input: Path
 
     def read_temp(self) -> int:
         return int(self.input.read_text().strip())
 
 
+class SensorGroup:
+    """Temp sensors read together once per tick, aggregated to a single temp
+
+    Sensor inputs are kept open and re-read with pread, rather than reopened every tick
+    """
+
+    def __init__(
+        self, sensors: list[TempSensor], aggregate: str = "max", weights: Sequence[float] = ()
+    ) -> None:
+        self.sensors = sensors
+        self.aggregate = aggregate
+        self.weights = list(weights) or [1.0] * len(sensors)
+        self.fds = [os.open(sensor.input, os.O_RDONLY) for sensor in sensors]
+        self.alarm_fds = [
+            os.open(path, os.O_RDONLY)
+            for sensor in sensors
+            for alarm in SENSOR_ALARMS
+            if (path := sensor.input.with_name(f"{sensor.idx}_{alarm}")).exists()
+        ]
+        # Only POLLPRI/POLLERR signal a sysfs_notify, attributes are always readable.
+        # Drivers that never notify simply leave poll() to time out
+        self.poller = select.poll()
+        for fd in self.fds + self.alarm_fds:
+            self.poller.register(fd, select.POLLPRI | select.POLLERR)
+        self._rearm(self.alarm_fds)
+        self.last_temps: list[Optional[int]] = []
+
+    def read_temps(self) -> list[Optional[int]]:
+        """Read every sensor, None for any that can not be read right now (e.g. powered off)"""
+        temps: list[Optional[int]] = []
+        for sensor, fd in zip(self.sensors, self.fds):
+            try:
+                temps.append(int(os.pread(fd, 16, 0)))
+            except (OSError, ValueError) as e:
+                logging.debug(f"Failed to read sensor '{sensor.label}': {e}")
+                temps.append(None)
+        return temps
+
+    def read_temp(self) -> int:
+        self.last_temps = self.read_temps()
+        readings = [
+            (temp, weight)
+            for temp, weight in zip(self.last_temps, self.weights)
+            if temp is not None
+        ]
+        if not readings:
+            raise IOError("No Temp sensors could be read")
+        if self.aggregate == "weighted":
+            return int(
+                sum(temp * weight for temp, weight in readings) / sum(w for _, w in readings)
+            )
+        return max(temp for temp, _ in readings)
+
+    def wait(self, timeout: float, min_wait: float = 0) -> bool:
+        """Wait up to timeout seconds, returns True if woken early by a sensor notification
+
+        Always waits at least min_wait, so a chatty driver can not spin the control loop
+        """
+        start = monotonic()
+        events = self.poller.poll(timeout * 1000)
+        if not events:
+            return False
+        # A notification is only cleared by reading the attribute again
+        self._rearm([fd for fd, _ in events])
+        sleep(max(0, min_wait - (monotonic() - start)))
+        return True
+
+    @staticmethod
+    def _rearm(fds: list[int]):
+        for fd in fds:
+            try:
+                os.pread(fd, 16, 0)
+            except OSError:
+                pass
+
+
+class AdaptiveInterval:
+    """Control loop interval: backs off towards max_interval while the temp is stable and
+    away from the thresholds, drops to min_interval when it rises quickly or nears the upper
+    threshold, and is interval otherwise. The backoff is limited by the headroom to the next
+    threshold up, so a spike towards it is seen sooner
+    """
+
+    def __init__(
+        self, min_interval: float, interval: float, max_interval: float, thresholds: "Thresholds"
+    ) -> None:
+        self.min_interval = min(min_interval, interval)
+        self.interval = interval
+        self.max_interval = max(max_interval, interval)
+        self.thresholds = thresholds
+        self.current = interval
+        self._last: Optional[tuple[float, int]] = None
+
+    def next(self, temp: int, average: int) -> float:
+        now = monotonic()
+        rate = 0.0
+        if self._last is not None and now > self._last[0]:
+            rate = (temp - self._last[1]) / (now - self._last[0])
+        self._last = (now, temp)
+        thresholds = self.thresholds
+        near_upper = thresholds.upper - thresholds.buffer <= average <= thresholds.upper
+        margin = min(abs(average - thresholds.lower), abs(average - thresholds.upper))
+        if rate >= FAST_RISE_RATE or (near_upper and rate > 0):
+            self.current = self.min_interval
+        elif abs(rate) <= STABLE_RATE and margin >= 2 * thresholds.buffer:
+            next_threshold = thresholds.lower if average < thresholds.lower else thresholds.upper
+            headroom = min(max(next_threshold - average, 0) / BACKOFF_HEADROOM, 1)
+            longest = self.interval + (self.max_interval - self.interval) * headroom
+            self.current = min(self.current * INTERVAL_BACKOFF, longest)
+        else:
+            self.current = self.interval
+        logging.debug(f"Next check in {self.current:.2f}s ({rate=:.0f}, {margin=})")
+        return self.current
+
+
 @dataclass
 class Thresholds:
     lower: int
@@ -56,19 +206,374 @@ class FanState(Enum):
     SYSTEM = 3
 
 
+class FanBackend(Protocol):
+    name: str
+
+    def get_state(self) -> int:
+        """Get the raw fan state, the same value i8kfan reports"""
+        ...
+
+    def set_state(self, state: FanState):
+        ...
+
+
+class HwmonFanBackend:
+    """dell_smm_hwmon pwm file, kept open and re-read/written at offset 0"""
+
+    name = "hwmon"
+
+    def __init__(self, pwm_path: Path) -> None:
+        self.pwm_path = pwm_path
+        self.fd = os.open(pwm_path, os.O_RDONLY if DRY_RUN else os.O_RDWR)
+
+    def get_state(self) -> int:
+        pwm = int(os.pread(self.fd, 16, 0))
+        return round(pwm * I8K_FAN_MAX / PWM_MAX)
+
+    def set_state(self, state: FanState):
+        os.pwrite(self.fd, str(state.value * PWM_MAX // I8K_FAN_MAX).encode(), 0)
+
+
+class ProcI8kFanBackend:
+    """/proc/i8k interface that i8kfan itself uses, read and set (ioctl) on one open fd"""
+
+    name = "proc"
+
+    def __init__(self, proc_path: str, fan_index: int) -> None:
+        self.fan_index = fan_index
+        self.fd = os.open(proc_path, os.O_RDONLY)
+
+    def get_state(self) -> int:
+        fields = os.pread(self.fd, 256, 0).decode().split()
+        return int(fields[I8K_PROC_FAN_STATE_FIELD + self.fan_index])
+
+    def set_state(self, state: FanState):
+        fcntl.ioctl(self.fd, I8K_SET_FAN, struct.pack("ii", self.fan_index, state.value))
+
+
+class I8kfanFanBackend:
+    """Fallback running i8kfan, which forks a process for every read and change"""
+
+    name = "i8kfan"
+
+    def __init__(self, fan_index: int) -> None:
+        self.fan_index = fan_index
+
+    def get_state(self) -> int:
+        logging.debug("Getting i8kfan state")
+        res = subprocess.run([I8KFAN], check=True, capture_output=True, text=True)
+        output = res.stdout.strip()
+        logging.debug(f"i8kfan output: {output}")
+        return int(output.split(" ")[self.fan_index])
+
+    def set_state(self, state: FanState):
+        # i8kfan takes left and right fan states, "-" leaves a fan unchanged
+        fan_args = ["-", "-"]
+        fan_args[self.fan_index] = str(state.value)
+        cmd = [I8KFAN, *fan_args]
+        logging.debug(f"Running command: {' '.join(cmd)}")
+        res = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        logging.debug(f"i8kfan output: {res.stdout.strip()}")
+
+
+class Controller(Protocol):
+    name: str
+
+    def request(
+        self,
+        temp: int,
+        weighted_average: int,
+        fan_state: int,
+        current: Optional[FanState],
+        now: float,
+    ) -> Optional[FanState]:
+        """Fan state wanted for the readings, None for no change
+
+        current is the last state requested, now a monotonic time in seconds
+        """
+        ...
+
+
+class ThresholdController:
+    """Simple threshold based temp controller
+
+    Provided lower,upper threshold can set the fan speed to one of 3 levels
+    if temp < lower threshold - set to minimum
+    if lower < temp < upper - set to mid
+    if temp > upper - set to max
+    """
+
+    name = "threshold"
+
+    def __init__(self, thresholds: Thresholds) -> None:
+        self.thresholds = thresholds
+
+    def request(
+        self,
+        temp: int,
+        weighted_average: int,
+        fan_state: int,
+        current: Optional[FanState],
+        now: float,
+    ) -> Optional[FanState]:
+        thresholds = self.thresholds
+        # NOTE: i8kfan reports weird fan states, the checks below are experimentally evaluated,
+        # but the target fan states should be correctly named
+        if min(weighted_average, temp) < thresholds.lower and fan_state != FanState.LOW:
+            return FanState.OFF
+        elif (
+            thresholds.upper > mean((temp, weighted_average)) > thresholds.lower
+            and fan_state != FanState.UNKNOWN
+        ):
+            return FanState.LOW
+        elif max(weighted_average, temp) > thresholds.upper and fan_state != FanState.HIGH:
+            return FanState.HIGH
+        return None
+
+
+class PidController:
+    """PID on the weighted average temp, around the midpoint of the thresholds
+
+    The output is a fan level (0 to I8K_FAN_MAX), by default LOW at the midpoint and a level
+    up/down for each half of the threshold range above/below it
+    """
+
+    name = "pid"
+
+    def __init__(
+        self,
+        thresholds: Thresholds,
+        kp: Optional[float] = None,
+        ki: Optional[float] = None,
+        kd: float = 0,
+    ) -> None:
+        self.thresholds = thresholds
+        self.setpoint = (thresholds.lower + thresholds.upper) / 2
+        # Gains are per milli-degree C, as are the temps
+        self.kp = kp / 1000 if kp is not None else 2 / (thresholds.upper - thresholds.lower)
+        self.ki = ki / 1000 if ki is not None else self.kp / PID_INTEGRAL_TIME
+        self.kd = kd / 1000
+        self.integral = 0.0
+        self._last: Optional[tuple[float, float]] = None
+
+    def request(
+        self,
+        temp: int,
+        weighted_average: int,
+        fan_state: int,
+        current: Optional[FanState],
+        now: float,
+    ) -> Optional[FanState]:
+        error = weighted_average - self.setpoint
+        derivative = 0.0
+        if self._last is not None and now > self._last[0]:
+            dt = now - self._last[0]
+            self.integral += error * dt
+            derivative = (error - self._last[1]) / dt
+        self._last = (now, error)
+        if self.ki:
+            # Anti-windup, the integral term alone never moves the output more than a level
+            self.integral = max(-1 / self.ki, min(self.integral, 1 / self.ki))
+        level = 1 + self.kp * error + self.ki * self.integral + self.kd * derivative
+        # Output as if the temp were a buffer hotter, for hysteresis on the way down
+        hot_level = level + self.kp * self.thresholds.buffer
+        logging.debug(f"PID output level: {level:.2f} (integral={self.ki * self.integral:.2f})")
+        return quantize_level(level, hot_level, current)
+
+
+class CurveController:
+    """Piecewise linear temp to fan level curve over the weighted average temp
+
+    The default curve crosses between levels at the lower and upper thresholds
+    """
+
+    name = "curve"
+
+    def __init__(
+        self, thresholds: Thresholds, points: Optional[list[tuple[int, float]]] = None
+    ) -> None:
+        self.thresholds = thresholds
+        if not points:
+            half_range = (thresholds.upper - thresholds.lower) // 2
+            points = [(thresholds.lower - half_range, 0), (thresholds.upper + half_range, 2)]
+        self.points = sorted(points)
+
+    def level(self, temp: float) -> float:
+        if temp <= self.points[0][0]:
+            return self.points[0][1]
+        for (t0, l0), (t1, l1) in zip(self.points, self.points[1:]):
+            if temp <= t1:
+                return l0 + (l1 - l0) * (temp - t0) / (t1 - t0)
+        return self.points[-1][1]
+
+    def request(
+        self,
+        temp: int,
+        weighted_average: int,
+        fan_state: int,
+        current: Optional[FanState],
+        now: float,
+    ) -> Optional[FanState]:
+        return quantize_level(
+            self.level(weighted_average),
+            self.level(weighted_average + self.thresholds.buffer),
+            current,
+        )
+
+
+class MinDwell:
+    """Hold each state requested by a controller for at least min_dwell seconds before
+    stepping down, stepping up is never delayed
+    """
+
+    def __init__(self, controller: Controller, min_dwell: float) -> None:
+        self.controller = controller
+        self.name = controller.name
+        self.min_dwell = min_dwell
+        self.since = 0.0
+
+    def request(
+        self,
+        temp: int,
+        weighted_average: int,
+        fan_state: int,
+        current: Optional[FanState],
+        now: float,
+    ) -> Optional[FanState]:
+        state = self.controller.request(temp, weighted_average, fan_state, current, now)
+        if state is None or state == current:
+            return state
+        if current is not None and state.value < current.value:
+            if now - self.since < self.min_dwell:
+                logging.debug(f"Holding {current.name} for minimum dwell, wanted {state.name}")
+                return None
+        self.since = now
+        return state
+
+
+def quantize_level(level: float, hot_level: float, current: Optional[FanState]) -> FanState:
+    """Fan state for a fan level, only stepping down from the current state once the level
+    for a buffer hotter temp (hot_level) is lower as well
+    """
+    state = FanState(max(0, min(int(level + 0.5), I8K_FAN_MAX)))
+    if current is None or current.value > I8K_FAN_MAX or state.value >= current.value:
+        return state
+    hot_state = max(0, min(int(hot_level + 0.5), I8K_FAN_MAX))
+    return FanState(max(state.value, min(current.value, hot_state)))
+
+
+class TraceRecorder:
+    """Append a CSV row per tick: time, aggregated temp, raw fan state, requested state and
+    the temp of each sensor, for replaying offline (see replay)
+    """
+
+    def __init__(self, path: str, labels: list[str]) -> None:
+        self.file: TextIO = open(path, "a", buffering=1)
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:
+            self.writer.writerow(TRACE_FIELDS + labels)
+
+    def record(
+        self,
+        temp: int,
+        temps: list[Optional[int]],
+        fan_state: int,
+        requested: Optional[FanState],
+    ):
+        self.writer.writerow(
+            [
+                f"{time():.3f}",
+                temp,
+                fan_state,
+                "" if requested is None else requested.value,
+                *("" if t is None else t for t in temps),
+            ]
+        )
+
+
+class SimulatedSensors:
+    """Stands in for a SensorGroup in replays, the temp is set by the thermal model"""
+
+    def __init__(self, temp: int) -> None:
+        self.temp = temp
+        self.last_temps: list[Optional[int]] = [temp]
+
+    def read_temp(self) -> int:
+        return self.temp
+
+
+class SimulatedFanBackend:
+    """Fan backend for replays, reports the state last set"""
+
+    name = "simulated"
+
+    def __init__(self, state: int = FanState.OFF.value) -> None:
+        self.state = state
+        self.changes = 0
+
+    def get_state(self) -> int:
+        return self.state
+
+    def set_state(self, state: FanState):
+        if state.value != self.state:
+            self.changes += 1
+        self.state = state.value
+
+
+@dataclass
+class ReplayResult:
+    ticks: int
+    duration: float
+    state_changes: int
+    time_above_upper: float
+    max_temp: int
+    cpu_per_tick: float
+
+
 def main():
     p = ArgumentParser()
-    p.add_argument("--module", required=True, help="hwmon module name (e.g. coretemp)")
+    p.add_argument(
+        "--module",
+        action="append",
+        help="hwmon module name (e.g. coretemp), can be repeated (e.g. --module nvme)",
+    )
     p.add_argument(
         "--interval",
         type=float,
         default=1,
         help="Interval between fan speed checks (in seconds) (Default: %(default)s)",
     )
+    p.add_argument(
+        "--min-interval",
+        type=float,
+        default=0.25,
+        help="Shortest interval, used when the temp rises fast (Default: %(default)s)",
+    )
+    p.add_argument(
+        "--max-interval",
+        type=float,
+        default=3,
+        help=(
+            "Longest interval, backed off to while the temp is stable and well below the next "
+            "threshold, set both limits to --interval for a fixed interval (Default: %(default)s)"
+        ),
+    )
     p.add_argument(
         "--sensor",
-        required=True,
-        help="Temp sensor Name regex (e.g. 'Package id \\d+')",
+        help="Temp sensor Name regex (e.g. 'Package id \\d+'), all matching sensors are used",
+    )
+    p.add_argument(
+        "--aggregate",
+        choices=["max", "weighted"],
+        default="max",
+        help="How to combine the temps of all matching sensors (Default: %(default)s)",
+    )
+    p.add_argument(
+        "--sensor-weight",
+        action="append",
+        default=[],
+        metavar="REGEX=WEIGHT",
+        help="Weight for sensors with labels matching REGEX in weighted aggregation (Default: 1)",
     )
     p.add_argument(
         "--threshold-lower",
@@ -94,6 +599,59 @@ def main():
         default=5,
         help="Threshold buffer (for debouncing) (Default: %(default)s)",
     )
+    p.add_argument(
+        "--controller",
+        choices=CONTROLLERS,
+        default="threshold",
+        help="Fan control mode (Default: %(default)s)",
+    )
+    p.add_argument(
+        "--pid-gains",
+        metavar="KP,KI,KD",
+        help="PID gains in fan levels per C, per C*s and per C/s (Default: from thresholds)",
+    )
+    p.add_argument(
+        "--curve",
+        metavar="TEMP:LEVEL,...",
+        help=(
+            "Fan level (0 to 2) curve points, e.g. '45:0,55:1,65:2' "
+            "(Default: changing level at the thresholds)"
+        ),
+    )
+    p.add_argument(
+        "--min-dwell",
+        type=float,
+        help=(
+            "Minimum time (in seconds) in a fan state before stepping down "
+            f"(Default: 0 for threshold, {MIN_DWELL} for the other controllers)"
+        ),
+    )
+    p.add_argument(
+        "--fan-backend",
+        choices=["auto", *FAN_BACKENDS],
+        default="auto",
+        help="How to read and set the fan state, auto picks one (Default: %(default)s)",
+    )
+    p.add_argument(
+        "--fan-index",
+        type=int,
+        choices=[0, 1],
+        default=1,
+        help="Fan to control, 0 for left and 1 for right as in i8kfan (Default: %(default)s)",
+    )
+    p.add_argument(
+        "--record",
+        metavar="FILE",
+        help="Append a CSV trace of temps and fan states each tick to FILE, for --replay",
+    )
+    p.add_argument(
+        "--replay",
+        metavar="FILE",
+        help=(
+            "Run the controller offline against a --record trace, with a simple thermal model "
+            "and a simulated fan, and report how it did"
+        ),
+    )
     p.add_argument(
         "--dry-run",
         "-d",
@@ -111,24 +669,65 @@ def main():
         log_fmt = "[%(levelname)8s] %(message)s"
     logging.basicConfig(level=log_lvl, format=log_fmt, datefmt="%Y-%m-%d %H:%M:%S")
 
-    if opts.dry_run:
-        global DRY_RUN
-        DRY_RUN = opts.dry_run
-
-    module_path = get_hwmon_module(opts.module)
-    logging.info(f"Monitor Module path: {module_path}")
-    sensor = get_temp_sensor(module_path, "Package id 0")
-    logging.info(f"Found Temp sensor: '{sensor.label}' -> reading: {sensor.read_temp() / 1000}C")
     thresholds = Thresholds.from_input(lower=opts.lower, upper=opts.upper, buffer=opts.buffer)
     logging.info(f"Using temp thresholds: {thresholds}")
+    min_dwell = opts.min_dwell
+    if min_dwell is None:
+        min_dwell = 0 if opts.controller == "threshold" else MIN_DWELL
+    try:
+        controller = get_controller(opts, thresholds)
+    except ValueError as e:
+        p.error(str(e))
+    if min_dwell > 0:
+        controller = MinDwell(controller, min_dwell)
+    logging.info(f"Using {controller.name} controller, minimum dwell {min_dwell}s")
     weights = range(TEMP_HIST * TEMP_WEIGHT_FACTOR, 1, -TEMP_WEIGHT_FACTOR)
     logging.info(f"Computed weights for rolling average: {list(weights)}")
+    if opts.replay:
+        report_replay(opts.replay, controller, thresholds, weights)
+        return 0
+    if not opts.module or not opts.sensor:
+        p.error("--module and --sensor are required, unless replaying a trace")
+
+    if opts.dry_run:
+        global DRY_RUN
+        DRY_RUN = opts.dry_run
+
+    module_paths = [path for module in opts.module for path in get_hwmon_modules(module)]
+    if not module_paths:
+        raise IOError("HwMon Module Not found")
+    logging.info(f"Monitor Module paths: {[str(path) for path in module_paths]}")
+    sensor_list = get_temp_sensors(module_paths, opts.sensor)
+    for sensor in sensor_list:
+        logging.info(
+            f"Found Temp sensor: '{sensor.label}' -> reading: {sensor.read_temp() / 1000}C"
+        )
+    try:
+        sensor_weights = get_sensor_weights(sensor_list, opts.sensor_weight)
+    except ValueError as e:
+        p.error(str(e))
+    sensors = SensorGroup(sensor_list, opts.aggregate, sensor_weights)
+    logging.info(f"Aggregated temp ({opts.aggregate}): {sensors.read_temp() / 1000}C")
+    recorder = None
+    if opts.record:
+        recorder = TraceRecorder(opts.record, [sensor.label for sensor in sensor_list])
+        logging.info(f"Recording trace to: {opts.record}")
+    fan = get_fan_backend(opts.fan_backend, opts.fan_index)
+    logging.info(f"Using fan backend: {fan.name} -> state: {fan.get_state()}")
     last_state_requested = None
     temp_readings = deque(maxlen=TEMP_HIST)
+    scheduler = AdaptiveInterval(opts.min_interval, opts.interval, opts.max_interval, thresholds)
     while True:
         try:
             last_state_requested = fancontrol(
-                sensor, thresholds, last_state_requested, temp_readings, weights
+                sensors,
+                fan,
+                controller,
+                last_state_requested,
+                temp_readings,
+                weights,
+                monotonic(),
+                recorder,
             )
         except Exception as e:
             # Catch any exceptions reading files etc, allowing to run forever
@@ -136,61 +735,179 @@ def main():
                 logging.info("Stopping with ctrl+c")
                 break
             logging.exception(e)
-        sleep(opts.interval)
+        interval = opts.interval
+        if temp_readings:
+            interval = scheduler.next(
+                temp_readings[0], get_weighted_average(temp_readings, weights)
+            )
+        if sensors.wait(interval, scheduler.min_interval):
+            logging.debug("Woken early by a sensor notification")
     return 0
 
 
 def fancontrol(
-    sensor: TempSensor,
-    thresholds: Thresholds,
+    sensors: SensorGroup,
+    fan: FanBackend,
+    controller: Controller,
     last_state_requested: Optional[FanState],
     temp_readings: deque[int],
     weights: Sequence[int],
+    now: float,
+    recorder: Optional[TraceRecorder] = None,
 ) -> Optional[FanState]:
-    """Simple threshold based temp controller
-
-    Provided lower,upper threshold can set the fan speed to one of 3 levels
-    if temp < lower threshold - set to minimum
-    if lower < temp < upper - set to mid
-    if temp > upper - set to max
-    """
-    fan_state = get_fan_state()
-    temp = sensor.read_temp()
+    """Read the temps and fan state, and set the fan state the controller asks for"""
+    fan_state = fan.get_state()
+    temp = sensors.read_temp()
     if not temp_readings:
         # Set initial values so that ramp-up isnt too slow starting
         temp_readings.extendleft([temp] * TEMP_HIST)
     temp_readings.appendleft(temp)
 
-    weighted_average = int(
-        sum(weight * val for weight, val in zip(weights, temp_readings)) / sum(weights)
-    )
+    weighted_average = get_weighted_average(temp_readings, weights)
     logging.debug(
         f"Running Fan control: {fan_state=}, {temp=}, {weighted_average=}, {temp_readings=}"
     )
-    # NOTE: i8kfan reports weird fan states, the checks below are experimentally evaluated,
-    # but the target fan states should be correctly named
-    if min(weighted_average, temp) < thresholds.lower and fan_state != FanState.LOW:
-        state_requested = set_fan_state(FanState.OFF, last_state_requested)
-    elif (
-        thresholds.upper > mean((temp, weighted_average)) > thresholds.lower
-        and fan_state != FanState.UNKNOWN
-    ):
-        state_requested = set_fan_state(FanState.LOW, last_state_requested)
-    elif max(weighted_average, temp) > thresholds.upper and fan_state != FanState.HIGH:
-        state_requested = set_fan_state(FanState.HIGH, last_state_requested)
-    else:
+    requested = controller.request(temp, weighted_average, fan_state, last_state_requested, now)
+    if requested is None:
         logging.debug("No Fan speed changes needed")
         state_requested = last_state_requested
+    else:
+        state_requested = set_fan_state(fan, requested, last_state_requested)
+    if recorder:
+        recorder.record(temp, sensors.last_temps, fan_state, state_requested)
     return state_requested
 
 
+def replay(
+    trace: list[tuple[float, int, int]],
+    controller: Controller,
+    thresholds: Thresholds,
+    weights: Sequence[int],
+) -> ReplayResult:
+    """Run fancontrol over a trace of (time, temp, fan state) with a simulated fan
+
+    The heat load at each tick is worked out from the recorded temp change and the recorded
+    fan state, then applied to a first order thermal model cooled by the simulated fan, so
+    a controller that runs the fan harder than the recording sees lower temps and vice versa
+    """
+    sensors = SimulatedSensors(trace[0][1])
+    fan = SimulatedFanBackend(trace[0][2])
+    last_state_requested = None
+    temp_readings: deque[int] = deque(maxlen=TEMP_HIST)
+    time_above_upper = 0.0
+    max_temp = sensors.temp
+    temp = float(sensors.temp)
+    start = process_time()
+    for (t0, recorded0, state0), (t1, recorded1, _) in zip(trace, trace[1:]):
+        dt = t1 - t0
+        if dt <= 0:
+            continue
+        last_state_requested = fancontrol(
+            sensors, fan, controller, last_state_requested, temp_readings, weights, t0
+        )
+        load = (recorded1 - recorded0) / dt + SIM_COOLING_RATES[state0] * (
+            recorded0 - SIM_AMBIENT_TEMP
+        )
+        cooling = SIM_COOLING_RATES[max(0, min(fan.state, I8K_FAN_MAX))]
+        temp += (load - cooling * (temp - SIM_AMBIENT_TEMP)) * dt
+        sensors.temp = int(temp)
+        if sensors.temp > thresholds.upper:
+            time_above_upper += dt
+        max_temp = max(max_temp, sensors.temp)
+    ticks = len(trace) - 1
+    return ReplayResult(
+        ticks=ticks,
+        duration=trace[-1][0] - trace[0][0],
+        state_changes=fan.changes,
+        time_above_upper=time_above_upper,
+        max_temp=max_temp,
+        cpu_per_tick=(process_time() - start) / max(ticks, 1),
+    )
+
+
+def report_replay(
+    trace_path: str, controller: Controller, thresholds: Thresholds, weights: Sequence[int]
+):
+    """Replay a trace and print the simulated results next to the recorded ones"""
+    trace = read_trace(trace_path)
+    if len(trace) < 2:
+        raise IOError(f"Not enough samples in trace to replay: {trace_path}")
+    recorded_changes = sum(1 for a, b in zip(trace, trace[1:]) if a[2] != b[2])
+    recorded_above = sum(
+        t1 - t0 for (t0, temp, _), (t1, _, _) in zip(trace, trace[1:]) if temp > thresholds.upper
+    )
+    # Fan changes are logged at info level, far too much output at thousands of ticks/sec
+    if not os.getenv("DEBUG"):
+        logging.disable(logging.INFO)
+    result = replay(trace, controller, thresholds, weights)
+    logging.disable(logging.NOTSET)
+    print(f"Replayed {result.ticks} ticks ({result.duration:.0f}s) with {controller.name}")
+    print(f"  state changes:      {result.state_changes} (recorded: {recorded_changes})")
+    print(f"  time above upper:   {result.time_above_upper:.0f}s (recorded: {recorded_above:.0f}s)")
+    print(
+        f"  max temp:           {result.max_temp / 1000:.1f}C "
+        f"(recorded: {max(temp for _, temp, _ in trace) / 1000:.1f}C)"
+    )
+    print(
+        f"  cpu per tick:       {result.cpu_per_tick * 1e6:.1f}us "
+        f"({1 / max(result.cpu_per_tick, 1e-9):.0f} ticks/sec)"
+    )
+
+
+def read_trace(path: str) -> list[tuple[float, int, int]]:
+    """Read a --record trace as (time, temp, fan state) samples
+
+    The fan state is the one requested where set, the raw state read from the fan otherwise
+    """
+    trace = []
+    with open(path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            state = int(row["requested"] or row["fan_state"])
+            trace.append((float(row["time"]), int(row["temp"]), max(0, min(state, I8K_FAN_MAX))))
+    return trace
+
+
+def get_controller(opts, thresholds: Thresholds) -> Controller:
+    """Build the controller selected in the options, ValueError for invalid settings"""
+    if opts.controller == "pid":
+        gains = [float(gain) for gain in opts.pid_gains.split(",")] if opts.pid_gains else []
+        if gains and len(gains) != 3:
+            raise ValueError(f"Expected KP,KI,KD for --pid-gains, got: {opts.pid_gains}")
+        return PidController(thresholds, *gains)
+    if opts.controller == "curve":
+        points = []
+        for point in opts.curve.split(",") if opts.curve else []:
+            temp, sep, level = point.partition(":")
+            if not sep:
+                raise ValueError(f"Expected TEMP:LEVEL for --curve points, got: {point}")
+            points.append((int(float(temp) * 1000), float(level)))
+        if opts.curve and len(points) < 2:
+            raise ValueError(f"At least two points needed for --curve, got: {opts.curve}")
+        return CurveController(thresholds, points)
+    return ThresholdController(thresholds)
+
+
+def get_weighted_average(temp_readings: deque[int], weights: Sequence[int]) -> int:
+    """Weighted moving average of the temp readings, newest first"""
+    return int(sum(weight * val for weight, val in zip(weights, temp_readings)) / sum(weights))
+
+
 def get_hwmon_module(module_name: str) -> Path:
     """Read hwmon module names and find the path for desired one
 
     since these could change on reboot if loaded in a different order
     """
+    paths = get_hwmon_modules(module_name)
+    if not paths:
+        raise IOError("HwMon Module Not found")
+    return paths[0]
+
+
+def get_hwmon_modules(module_name: str) -> list[Path]:
+    """Get the paths of all hwmon devices of a module (e.g. one per NVMe drive)"""
     hwmon_base = Path(HWMON_BASE)
-    for path in hwmon_base.iterdir():
+    paths = []
+    for path in sorted(hwmon_base.iterdir()):
         logging.debug(f"Checking path: {path}")
         mod_name_file = path / "name"
         try:
@@ -201,41 +918,78 @@ def get_hwmon_module(module_name: str) -> Path:
             continue
         if mod_name == module_name:
             logging.info(f"Found module name: {mod_name}")
-            return path
-    raise IOError("HwMon Module Not found")
+            paths.append(path)
+    return paths
+
 
+def get_temp_sensors(module_paths: list[Path], sensor_name_re: str) -> list[TempSensor]:
+    """Given Hwmon modules and desired sensor regex, get the metadata of all matching sensors
 
-def get_temp_sensor(module_path: Path, sensor_name_re: str) -> TempSensor:
-    """Given Hwmon module and desired sensor regex, get the sensor metadata"""
+    Sensors without a label (e.g. some GPUs) are matched by their index, e.g. 'temp1'
+    """
     matcher = re.compile(sensor_name_re)
-    for s_name_path in module_path.glob("temp*_label"):
-        sensor_label = s_name_path.read_text().strip()
-        logging.debug(f"Checking sensor label from: {s_name_path}")
-        if matcher.match(sensor_label):
-            sensor_index = s_name_path.name.replace("_label", "")
+    sensors = []
+    for module_path in module_paths:
+        for input_path in sorted(module_path.glob("temp*_input")):
+            sensor_index = input_path.name.replace("_input", "")
+            label_path = module_path / f"{sensor_index}_label"
+            sensor_label = label_path.read_text().strip() if label_path.exists() else sensor_index
+            logging.debug(f"Checking sensor label from: {label_path}")
+            if not matcher.match(sensor_label):
+                continue
             logging.debug(f"Found Temp sensor label match: {sensor_label}")
-            break
-    else:
+            max_temp = None
+            for limit in ("max", "crit"):
+                if (limit_path := module_path / f"{sensor_index}_{limit}").exists():
+                    max_temp = int(limit_path.read_text().strip())
+                    break
+            sensors.append(
+                TempSensor(label=sensor_label, idx=sensor_index, max=max_temp, input=input_path)
+            )
+    if not sensors:
         raise IOError("Temp Sensor Not found")
-    max_temp = int((module_path / f"{sensor_index}_max").read_text().strip())
-    return TempSensor(
-        label=sensor_label,
-        idx=sensor_index,
-        max=max_temp,
-        input=module_path / f"{sensor_index}_input",
-    )
+    return sensors
+
+
+def get_sensor_weights(sensors: list[TempSensor], weight_specs: list[str]) -> list[float]:
+    """Weight of each sensor from 'REGEX=WEIGHT' specs, the first matching spec is used
+
+    ValueError for an invalid spec
+    """
+    specs = []
+    for spec in weight_specs:
+        label_re, sep, weight = spec.rpartition("=")
+        try:
+            if not sep:
+                raise ValueError("missing '='")
+            specs.append((re.compile(label_re), float(weight)))
+        except (ValueError, re.error) as e:
+            raise ValueError(f"Invalid --sensor-weight '{spec}', expected REGEX=WEIGHT: {e}")
+    return [
+        next((weight for matcher, weight in specs if matcher.match(sensor.label)), 1.0)
+        for sensor in sensors
+    ]
 
 
-def get_fan_state() -> int:
-    logging.debug("Getting i8kfan state")
-    res = subprocess.run([I8KFAN], check=True, capture_output=True, text=True)
-    output = res.stdout.strip()
-    logging.debug(f"i8kfan output: {output}")
-    fan_status = output.split(" ")[-1]
-    return int(fan_status)
+def get_fan_backend(backend: str, fan_index: int) -> FanBackend:
+    """Open the fan backend, "auto" uses the first of FAN_BACKENDS that is available"""
+    for name in FAN_BACKENDS if backend == "auto" else [backend]:
+        try:
+            if name == "hwmon":
+                pwm_path = get_hwmon_module(DELL_SMM_MODULE) / f"pwm{fan_index + 1}"
+                return HwmonFanBackend(pwm_path)
+            if name == "proc":
+                return ProcI8kFanBackend(I8K_PROC, fan_index)
+        except IOError as e:
+            if backend != "auto":
+                raise
+            logging.debug(f"Fan backend {name} not available: {e}")
+    return I8kfanFanBackend(fan_index)
 
 
-def set_fan_state(requested_fan_state: FanState, last_fan_state: Optional[FanState]) -> FanState:
+def set_fan_state(
+    fan: FanBackend, requested_fan_state: FanState, last_fan_state: Optional[FanState]
+) -> FanState:
     if last_fan_state == requested_fan_state and last_fan_state is not None:
         logging.debug(
             f"Last Fan state = Requested Fan State ({requested_fan_state}), "
@@ -243,13 +997,10 @@ def set_fan_state(requested_fan_state: FanState, last_fan_state: Optional[FanSta
         )
         return last_fan_state
     logging.info(f"Setting Fan speed to {requested_fan_state.name}")
-    cmd = [I8KFAN, "-", str(requested_fan_state.value)]
-    logging.debug(f"Running command: {' '.join(cmd)}")
     if DRY_RUN:
-        logging.info(f"DRY_RUN Mode, would have executed: '{cmd}'")
+        logging.info(f"DRY_RUN Mode, would have set {fan.name} fan state: {requested_fan_state}")
     else:
-        res = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        logging.debug(f"i8kfan output: {res.stdout.strip()}")
+        fan.set_state(requested_fan_state)
     return requested_fan_state
 
 